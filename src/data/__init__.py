@@ -3,6 +3,7 @@ from data.fsmol_batcher import (
     FSMolBatcher,
     MATBatcher,
     fsmol_batch_finalizer,
+    node_features_to_active_ids,
     FSMolBatchIterable,
 )
 from data.fsmol_dataset import (
@@ -33,6 +34,7 @@ __all__ = [
     MATBatcher,
     FSMolBatchIterable,
     fsmol_batch_finalizer,
+    node_features_to_active_ids,
     DataFold,
     FSMolDataset,
     default_reader_fn,
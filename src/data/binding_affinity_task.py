@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from itertools import chain
 from typing import List, Optional, Tuple
 
 import numpy as np
@@ -11,6 +12,25 @@ sys.path.insert(0, str(project_root()))
 
 from data.fsmol_task import MoleculeDatapoint, get_task_name_from_path, GraphData
 
+
+def _concat_and_split(
+    per_graph_values: List[List[List[float]]], dtype: np.dtype, row_width: int
+) -> List[np.ndarray]:
+    """Build a single contiguous array out of per-graph nested lists and split it back into
+    per-graph views, so that all graphs of a file share one buffer."""
+    lengths = np.fromiter(
+        (len(values) for values in per_graph_values), dtype=np.int64, count=len(per_graph_values)
+    )
+    num_rows = int(lengths.sum())
+    # Fill a pre-sized buffer straight from the nested lists, without intermediate row objects:
+    flat = np.fromiter(
+        chain.from_iterable(chain.from_iterable(per_graph_values)),
+        dtype=dtype,
+        count=num_rows * row_width,
+    )
+    return np.split(flat.reshape(num_rows, row_width), np.cumsum(lengths)[:-1], axis=0)
+
+
 @dataclass(frozen=True)
 class BindingAffinityTask:
     """Data structure to hold information from binding_affinities jsonl files.
@@ -24,35 +44,84 @@ class BindingAffinityTask:
 
     @staticmethod
     def load_from_file(path: RichPath) -> "BindingAffinityTask":
-        samples = []
-        for raw_sample in path.read_by_file_suffix():
-            graph_data = raw_sample.get("graph")
-            adjacency_lists = []
-            for adj_list in graph_data["adjacency_lists"]:
-                if len(adj_list) > 0:
-                    adjacency_lists.append(np.array(adj_list, dtype=np.int64))
-                else:
-                    adjacency_lists.append(np.zeros(shape=(0, 2), dtype=np.int64))
-            samples.append(
-                MoleculeDatapoint(
-                    task_name=get_task_name_from_path(path),
-                    smiles=raw_sample["SMILES"],
-                    bool_label=False,
-                    numeric_label=float(raw_sample.get("RegressionProperty") or "nan"),
-                    fingerprint=None,
-                    descriptors=None,
-                    graph=GraphData(
-                        node_features=np.array(graph_data["node_features"], dtype=np.float32),
-                        adjacency_lists=adjacency_lists,
-                        edge_features=[
-                            np.array(edge_feats, dtype=np.float32)
-                            for edge_feats in graph_data.get("edge_features") or []
-                        ],
-                    ),
+        task_name = get_task_name_from_path(path)
+        raw_samples = list(path.read_by_file_suffix())
+        if len(raw_samples) == 0:
+            return BindingAffinityTask(task_name, [])
+
+        # Parse the whole file column-wise: one array per feature type, which is then split into
+        # per-molecule views (instead of allocating many small arrays per molecule).
+        graphs_data = [raw_sample["graph"] for raw_sample in raw_samples]
+        # Take the feature width from the first molecule that has any atoms:
+        num_node_features = next(
+            (len(g["node_features"][0]) for g in graphs_data if len(g["node_features"]) > 0), 0
+        )
+        # Node features are (mostly binary) atom descriptors, which float16 represents exactly;
+        # this halves their size in memory and in transfers to the device, and the model upcasts
+        # them:
+        node_features = _concat_and_split(
+            [graph_data["node_features"] for graph_data in graphs_data],
+            dtype=np.float16,
+            row_width=num_node_features,
+        )
+
+        num_edge_types = len(graphs_data[0]["adjacency_lists"])
+        adjacency_lists_by_type = [
+            _concat_and_split(
+                [graph_data["adjacency_lists"][edge_type] for graph_data in graphs_data],
+                dtype=np.int64,
+                row_width=2,
+            )
+            for edge_type in range(num_edge_types)
+        ]
+
+        edge_features_by_type = []
+        edge_features_data = [graph_data.get("edge_features") or [] for graph_data in graphs_data]
+        if any(len(edge_features) > 0 for edge_features in edge_features_data):
+            for edge_type in range(num_edge_types):
+                # Only some graphs may carry edge features; the others get zero-width arrays (one
+                # row per edge), as the batchers use for graphs without edge features:
+                graph_ids = [
+                    i for i, edge_features in enumerate(edge_features_data)
+                    if len(edge_features) > edge_type
+                ]
+                edge_feats = [edge_features_data[i][edge_type] for i in graph_ids]
+                edge_feat_dim = max((len(e[0]) for e in edge_feats if len(e) > 0), default=0)
+                type_edge_features = [
+                    np.zeros(shape=(len(adj_lists), 0), dtype=np.float32)
+                    for adj_lists in adjacency_lists_by_type[edge_type]
+                ]
+                split_edge_feats = _concat_and_split(
+                    edge_feats, dtype=np.float32, row_width=edge_feat_dim
                 )
+                for i, graph_edge_feats in zip(graph_ids, split_edge_feats):
+                    type_edge_features[i] = graph_edge_feats
+                edge_features_by_type.append(type_edge_features)
+
+        # Missing scores may be written as null (e.g. by orjson, which cannot encode NaN), so read
+        # them back as NaN:
+        numeric_labels = np.array(
+            [raw_sample.get("RegressionProperty") for raw_sample in raw_samples], dtype=np.float64
+        )
+
+        samples = [
+            MoleculeDatapoint(
+                task_name=task_name,
+                smiles=raw_sample["SMILES"],
+                bool_label=False,
+                numeric_label=numeric_labels[i],
+                fingerprint=None,
+                descriptors=None,
+                graph=GraphData(
+                    node_features=node_features[i],
+                    adjacency_lists=[adj_lists[i] for adj_lists in adjacency_lists_by_type],
+                    edge_features=[edge_feats[i] for edge_feats in edge_features_by_type],
+                ),
             )
+            for i, raw_sample in enumerate(raw_samples)
+        ]
 
-        return BindingAffinityTask(get_task_name_from_path(path), samples)
+        return BindingAffinityTask(task_name, samples)
 
 @dataclass(frozen=True)
 class BindingAffinityTaskSample:
@@ -1,5 +1,6 @@
 import dataclasses
 import logging
+import math
 import sys
 from collections import defaultdict
 from dataclasses import dataclass
@@ -14,6 +15,7 @@ from pyprojroot import here as project_root
 sys.path.insert(0, str(project_root()))
 
 from data import (
+    NUM_EDGE_TYPES,
     DataFold,
     FSMolDataset,
     BindingAffinityTask,
@@ -22,8 +24,10 @@ from data import (
     FSMolBatcher,
     MoleculeDatapoint,
     fsmol_batch_finalizer,
+    node_features_to_active_ids,
 )
-from utils.torch_utils import torchify
+from data.fsmol_task import get_task_name_from_path
+from utils.torch_utils import DataPrefetcher, ThreadedPrefetcher, torchify
 
 
 logger = logging.getLogger(__name__)
@@ -56,7 +60,8 @@ def multitask_batcher_finalizer_fn(
             sample_to_task_id=np.stack(batch_data["sample_to_task_id"], axis=0),
             **dataclasses.asdict(plain_batch),
         ),
-        np.stack(batch_data["numeric_labels"], axis=0),
+        # Labels are compared to float32 predictions, so convert them once here:
+        np.array(batch_data["numeric_labels"], dtype=np.float32),
     )
 
 
@@ -66,9 +71,13 @@ def get_multitask_batcher(
     max_num_nodes: Optional[int] = None,
     max_num_edges: Optional[int] = None,
     device: Optional[torch.device] = None,
+    use_active_node_feature_ids: bool = False,
 ) -> FSMolBatcher[FSMolMultitaskBatch, np.ndarray]:
     def finalizer(batch_data: Dict[str, Any]):
         finalized_batch = multitask_batcher_finalizer_fn(batch_data)
+        if use_active_node_feature_ids:
+            batch, _ = finalized_batch
+            batch.node_features = node_features_to_active_ids(batch.node_features)
         if device is not None:
             finalized_batch = torchify(finalized_batch, device)
 
@@ -86,6 +95,23 @@ def get_multitask_batcher(
     )
 
 
+def size_bucketed_order(num_nodes: np.ndarray, shuffle: bool) -> np.ndarray:
+    """Order molecules such that molecules of similar size end up next to each other, and hence in
+    the same batches. Molecules are grouped into buckets of power-of-two ranges of node counts
+    (i.e., (2^(k-1), 2^k]), and buckets are ordered by size.
+
+    Args:
+        num_nodes: int array of shape [N], number of nodes of each molecule.
+        shuffle: Flag indicating if molecules should be randomly ordered within their bucket.
+
+    Returns:
+        int array of shape [N], a permutation of the molecules.
+    """
+    order = np.random.permutation(len(num_nodes)) if shuffle else np.arange(len(num_nodes))
+    buckets = np.ceil(np.log2(np.maximum(num_nodes[order], 1))).astype(np.int64)
+    return order[np.argsort(buckets, kind="stable")]
+
+
 def get_multitask_inference_batcher(
     max_num_graphs: int,
     device: torch.device,
@@ -99,7 +125,216 @@ def get_multitask_inference_batcher(
     )
 
 
+@dataclass(frozen=True)
+class DeviceGraphTable:
+    """Graphs of a set of molecules, stored as flat tensors on a device, so that batches can be
+    assembled by index-gathering instead of copying the graphs from host memory every epoch.
+
+    Args:
+        node_features: node features of all molecules, [V, node_feat_dim] float.
+        adjacency_lists: edges of all molecules by edge type, list of [E, 2] long tensors.
+            Node ids are local to each molecule.
+        edge_features: edge features of all molecules by edge type, list of [E, ED] float tensors.
+        node_offsets: index of the first node of each molecule in node_features, [N + 1] long.
+        edge_offsets: index of the first edge of each molecule by edge type, list of [N + 1]
+            long tensors.
+        numeric_labels: label of each molecule, [N] float.
+        task_ids: task id of each molecule, [N] long.
+        smiles: SMILES string of each molecule.
+        num_nodes: number of nodes of each molecule, kept on the host to make batching decisions
+            without synchronising with the device. [N] int.
+        num_edges: number of edges of each molecule by edge type, kept on the host.
+            [num_edge_types, N] int.
+    """
+
+    node_features: torch.Tensor
+    adjacency_lists: List[torch.Tensor]
+    edge_features: List[torch.Tensor]
+    node_offsets: torch.Tensor
+    edge_offsets: List[torch.Tensor]
+    numeric_labels: torch.Tensor
+    task_ids: torch.Tensor
+    smiles: List[str]
+    num_nodes: np.ndarray
+    num_edges: np.ndarray
+
+    @property
+    def num_molecules(self) -> int:
+        return len(self.smiles)
+
+    @staticmethod
+    def from_datapoints(
+        datapoints: List[MoleculeDatapoint], task_id: int, device: torch.device
+    ) -> "DeviceGraphTable":
+        def to_offsets(counts: np.ndarray) -> torch.Tensor:
+            return torch.from_numpy(np.concatenate(([0], np.cumsum(counts)))).to(device)
+
+        num_nodes = np.array([len(d.graph.node_features) for d in datapoints], dtype=np.int64)
+        num_edges = np.array(
+            [[len(d.graph.adjacency_lists[t]) for d in datapoints] for t in range(NUM_EDGE_TYPES)],
+            dtype=np.int64,
+        ).reshape(NUM_EDGE_TYPES, len(datapoints))
+
+        adjacency_lists, edge_features = [], []
+        for edge_type in range(NUM_EDGE_TYPES):
+            adjacency_lists.append(
+                np.concatenate(
+                    [np.zeros(shape=(0, 2), dtype=np.int64)]
+                    + [d.graph.adjacency_lists[edge_type] for d in datapoints],
+                    axis=0,
+                )
+            )
+            edge_feats = [
+                d.graph.edge_features[edge_type]
+                if len(d.graph.edge_features) > edge_type
+                else np.zeros(shape=(len(d.graph.adjacency_lists[edge_type]), 0), dtype=np.float32)
+                for d in datapoints
+            ]
+            edge_features.append(np.concatenate(edge_feats, axis=0))
+
+        return DeviceGraphTable(
+            node_features=torch.from_numpy(
+                np.concatenate([d.graph.node_features for d in datapoints], axis=0)
+            ).to(device),
+            adjacency_lists=[torch.from_numpy(adj_list).to(device) for adj_list in adjacency_lists],
+            edge_features=[torch.from_numpy(edge_feats).to(device) for edge_feats in edge_features],
+            node_offsets=to_offsets(num_nodes),
+            edge_offsets=[to_offsets(num_edges[t]) for t in range(NUM_EDGE_TYPES)],
+            numeric_labels=torch.from_numpy(
+                np.array([d.numeric_label for d in datapoints], dtype=np.float32)
+            ).to(device),
+            task_ids=torch.full(
+                size=(len(datapoints),), fill_value=task_id, dtype=torch.long, device=device
+            ),
+            smiles=[d.smiles for d in datapoints],
+            num_nodes=num_nodes,
+            num_edges=num_edges,
+        )
+
+    @staticmethod
+    def gather_batch(
+        tables: List["DeviceGraphTable"], table_ids: np.ndarray, molecule_ids: np.ndarray
+    ) -> Tuple[FSMolMultitaskBatch, torch.Tensor]:
+        """Assemble molecule molecule_ids[i] of table tables[table_ids[i]], for all i, into one
+        batch on the tables' device. Only the batch's molecules are read from the tables, so the
+        cost is proportional to the size of the batch, not of the tables."""
+
+        def segment_gather_index(starts: torch.Tensor, counts: torch.Tensor, total: int):
+            # Indices selecting the ranges [starts[i], starts[i] + counts[i]) one after another:
+            out_starts = torch.cumsum(counts, dim=0) - counts
+            return torch.arange(total, device=starts.device) + torch.repeat_interleave(
+                starts - out_starts, counts, output_size=total
+            )
+
+        device = tables[0].node_features.device
+        num_graphs = len(molecule_ids)
+
+        # Sizes of the batch's molecules (on the host), and which of them come from each table:
+        mol_num_nodes = np.empty(num_graphs, dtype=np.int64)
+        mol_num_edges = np.empty((NUM_EDGE_TYPES, num_graphs), dtype=np.int64)
+        table_molecules = []
+        for table_id in np.unique(table_ids):
+            table = tables[table_id]
+            positions = np.flatnonzero(table_ids == table_id)
+            ids = molecule_ids[positions]
+            mol_num_nodes[positions] = table.num_nodes[ids]
+            mol_num_edges[:, positions] = table.num_edges[:, ids]
+            table_molecules.append(
+                (
+                    table,
+                    positions,
+                    torch.from_numpy(positions).to(device),
+                    torch.from_numpy(ids).to(device),
+                )
+            )
+
+        num_nodes = int(mol_num_nodes.sum())
+        node_counts = torch.from_numpy(mol_num_nodes).to(device)
+        batch_node_offsets = torch.cumsum(node_counts, dim=0) - node_counts
+
+        node_features = torch.empty(
+            (num_nodes,) + tuple(tables[0].node_features.shape[1:]),
+            dtype=tables[0].node_features.dtype,
+            device=device,
+        )
+        numeric_labels = torch.empty(
+            num_graphs, dtype=tables[0].numeric_labels.dtype, device=device
+        )
+        task_ids = torch.empty(num_graphs, dtype=torch.long, device=device)
+        for table, positions, positions_t, ids in table_molecules:
+            counts = node_counts[positions_t]
+            total = int(mol_num_nodes[positions].sum())
+            node_idx = segment_gather_index(table.node_offsets[ids], counts, total)
+            batch_node_idx = segment_gather_index(batch_node_offsets[positions_t], counts, total)
+            node_features[batch_node_idx] = table.node_features[node_idx]
+            numeric_labels[positions_t] = table.numeric_labels[ids]
+            task_ids[positions_t] = table.task_ids[ids]
+
+        adjacency_lists, edge_features = [], []
+        for edge_type in range(NUM_EDGE_TYPES):
+            num_type_edges = int(mol_num_edges[edge_type].sum())
+            edge_counts = torch.from_numpy(mol_num_edges[edge_type]).to(device)
+            batch_edge_offsets = torch.cumsum(edge_counts, dim=0) - edge_counts
+            type_adjacency_list = torch.empty(
+                (num_type_edges, 2), dtype=tables[0].adjacency_lists[edge_type].dtype, device=device
+            )
+            type_edge_features = torch.empty(
+                (num_type_edges,) + tuple(tables[0].edge_features[edge_type].shape[1:]),
+                dtype=tables[0].edge_features[edge_type].dtype,
+                device=device,
+            )
+            for table, positions, positions_t, ids in table_molecules:
+                counts = edge_counts[positions_t]
+                total = int(mol_num_edges[edge_type, positions].sum())
+                edge_idx = segment_gather_index(table.edge_offsets[edge_type][ids], counts, total)
+                batch_edge_idx = segment_gather_index(batch_edge_offsets[positions_t], counts, total)
+                type_adjacency_list[batch_edge_idx] = table.adjacency_lists[edge_type][edge_idx]
+                type_edge_features[batch_edge_idx] = table.edge_features[edge_type][edge_idx]
+
+            # Node ids are local to each molecule, so shift them by the molecule's first node:
+            edge_node_offsets = torch.repeat_interleave(
+                batch_node_offsets, edge_counts, output_size=num_type_edges
+            )
+            adjacency_lists.append(type_adjacency_list + edge_node_offsets.unsqueeze(-1))
+            edge_features.append(type_edge_features)
+
+        batch = FSMolMultitaskBatch(
+            num_graphs=num_graphs,
+            num_nodes=num_nodes,
+            num_edges=int(mol_num_edges.sum()),
+            node_features=node_features,
+            adjacency_lists=adjacency_lists,
+            edge_features=edge_features,
+            node_to_graph=torch.repeat_interleave(
+                torch.arange(num_graphs, device=device), node_counts, output_size=num_nodes
+            ),
+            smiles=[tables[t].smiles[i] for t, i in zip(table_ids, molecule_ids)],
+            sample_to_task_id=task_ids,
+        )
+        return batch, numeric_labels
+
+
 class MultitaskTaskSampleBatchIterable(Iterable[Tuple[FSMolMultitaskBatch, torch.Tensor]]):
+    """Iterable over batches of molecules sampled from the tasks of a dataset fold.
+
+    Args:
+        cache_graphs_on_device: If set, the graphs of each task are uploaded to device once, and
+            batches are assembled on device from these (only the indices of the sampled
+            molecules are copied per batch). Tasks are then read in the main process, so the
+            first pass over the data is slower, and all graphs of the fold need to fit in device
+            memory.
+        num_prefetched_batches: Number of batches to collect from the reader processes in a
+            background thread ahead of their use, so that receiving (and, on CPU, converting)
+            batches overlaps with training on earlier ones. 0 disables the background thread.
+        bucket_by_num_nodes: If set, molecules are batched together with molecules of similar size
+            (see size_bucketed_order), and the order of batches is shuffled instead. Combined
+            with max_num_nodes, this yields batches of similar size with little variation in
+            their number of graphs.
+        use_active_node_feature_ids: If set, (binary) node features are passed on as the indices
+            of their active entries, which are much smaller to transfer to the device (see
+            node_features_to_active_ids). Does not apply to cache_graphs_on_device.
+    """
+
     def __init__(
         self,
         dataset: FSMolDataset,
@@ -112,24 +347,130 @@ class MultitaskTaskSampleBatchIterable(Iterable[Tuple[FSMolMultitaskBatch, torch
         # TODO(cfifty): put back to 8 later on.
         num_chunked_tasks: int = 8,
         repeat: bool = False,
+        cache_graphs_on_device: bool = False,
+        num_prefetched_batches: int = 4,
+        bucket_by_num_nodes: bool = False,
+        use_active_node_feature_ids: bool = False,
     ):
         self._dataset = dataset
         self._data_fold = data_fold
+        self._task_name_to_id = task_name_to_id
         self._num_chunked_tasks = num_chunked_tasks
         self._repeat = repeat
         self._device = device
+        self._max_num_graphs = max_num_graphs or math.inf
+        self._max_num_nodes = max_num_nodes or math.inf
+        self._max_num_edges = max_num_edges or math.inf
+        self._cache_graphs_on_device = cache_graphs_on_device
+        self._device_graph_cache: Dict[str, DeviceGraphTable] = {}
+        self._num_prefetched_batches = num_prefetched_batches
+        self._bucket_by_num_nodes = bucket_by_num_nodes
 
+        self._task_sample_size = 1024
         self._task_sampler = RandomTaskSampler(
-            train_size_or_ratio=1024, valid_size_or_ratio=0, test_size_or_ratio=0
+            train_size_or_ratio=self._task_sample_size, valid_size_or_ratio=0, test_size_or_ratio=0
         )
         self._batcher = get_multitask_batcher(
             task_name_to_id=task_name_to_id,
             max_num_graphs=max_num_graphs,
             max_num_nodes=max_num_nodes,
             max_num_edges=max_num_edges,
+            use_active_node_feature_ids=use_active_node_feature_ids,
         )
 
+    def __get_device_graph_table(self, path: RichPath) -> DeviceGraphTable:
+        task_name = get_task_name_from_path(path)
+        table = self._device_graph_cache.get(task_name)
+        if table is None:
+            task = BindingAffinityTask.load_from_file(path)
+            table = DeviceGraphTable.from_datapoints(
+                task.samples, task_id=self._task_name_to_id[task_name], device=self._device
+            )
+            self._device_graph_cache[task_name] = table
+        return table
+
+    def __batch_molecule_ids(
+        self,
+        tables: List[DeviceGraphTable],
+        table_ids: np.ndarray,
+        molecule_ids: np.ndarray,
+        num_nodes: np.ndarray,
+        num_edges: np.ndarray,
+    ):
+        # Same batch boundaries as FSMolBatcher.batch, computed from the host-side sizes:
+        batch_start, batch_num_nodes, batch_num_edges = 0, 0, 0
+        for i in range(len(molecule_ids)):
+            mol_num_nodes, mol_num_edges = num_nodes[i], num_edges[i]
+            if (
+                (i - batch_start + 1 > self._max_num_graphs)
+                or (batch_num_nodes + mol_num_nodes > self._max_num_nodes)
+                or (batch_num_edges + mol_num_edges > self._max_num_edges)
+            ):
+                yield DeviceGraphTable.gather_batch(
+                    tables, table_ids[batch_start:i], molecule_ids[batch_start:i]
+                )
+                batch_start, batch_num_nodes, batch_num_edges = i, 0, 0
+            batch_num_nodes += mol_num_nodes
+            batch_num_edges += mol_num_edges
+
+        if len(molecule_ids) - batch_start > 1:  # single-element batches are problematic for BatchNorm
+            yield DeviceGraphTable.gather_batch(
+                tables, table_ids[batch_start:], molecule_ids[batch_start:]
+            )
+
     def __iter__(self) -> Iterator[Tuple[FSMolMultitaskBatch, torch.Tensor]]:
+        def paths_to_cached_batches(
+            paths: List[RichPath], idx: int
+        ) -> Iterable[Tuple[FSMolMultitaskBatch, torch.Tensor]]:
+            # Molecules are identified by their table and their id in that table, so that batches
+            # are gathered from the per-task tables directly:
+            tables, table_ids, molecule_ids, num_nodes, num_edges = [], [], [], [], []
+            for i, path in enumerate(paths):
+                table = self.__get_device_graph_table(path)
+                # Sample molecule ids in the same way RandomTaskSampler samples molecules:
+                rng = np.random.Generator(np.random.PCG64(seed=idx + i))
+                task_molecule_ids = np.arange(table.num_molecules)
+                rng.shuffle(task_molecule_ids)
+                sampled_ids = task_molecule_ids[: self._task_sample_size]
+                tables.append(table)
+                table_ids.append(np.full(len(sampled_ids), i))
+                molecule_ids.append(sampled_ids)
+                num_nodes.append(table.num_nodes[sampled_ids])
+                num_edges.append(table.num_edges[:, sampled_ids].sum(axis=0))
+            table_ids = np.concatenate(table_ids)
+            molecule_ids = np.concatenate(molecule_ids)
+            num_nodes = np.concatenate(num_nodes)
+            num_edges = np.concatenate(num_edges)
+
+            if self._bucket_by_num_nodes:
+                order = size_bucketed_order(num_nodes, shuffle=self._data_fold == DataFold.TRAIN)
+            else:
+                order = np.arange(len(molecule_ids))
+                if self._data_fold == DataFold.TRAIN:
+                    np.random.shuffle(order)
+            table_ids, molecule_ids = table_ids[order], molecule_ids[order]
+            num_nodes, num_edges = num_nodes[order], num_edges[order]
+
+            batches = self.__batch_molecule_ids(
+                tables, table_ids, molecule_ids, num_nodes, num_edges
+            )
+            if self._bucket_by_num_nodes and self._data_fold == DataFold.TRAIN:
+                # Batches are ordered by the size of their molecules, so mix them up:
+                batches = list(batches)
+                np.random.shuffle(batches)
+            yield from batches
+
+        if self._cache_graphs_on_device:
+            return iter(
+                self._dataset.get_task_reading_iterable(
+                    data_fold=self._data_fold,
+                    task_reader_fn=paths_to_cached_batches,
+                    repeat=self._repeat,
+                    reader_chunk_size=self._num_chunked_tasks,
+                    num_workers=0,
+                )
+            )
+
         def paths_to_mixed_samples(
             paths: List[RichPath], idx: int
         ) -> Iterable[Tuple[FSMolMultitaskBatch, np.ndarray]]:
@@ -138,19 +479,40 @@ class MultitaskTaskSampleBatchIterable(Iterable[Tuple[FSMolMultitaskBatch, torch
                 task = BindingAffinityTask.load_from_file(path)
                 task_sample = self._task_sampler.sample(task, seed=idx + i)
                 loaded_samples.extend(task_sample.train_samples)
-            if self._data_fold == DataFold.TRAIN:
+            if self._bucket_by_num_nodes:
+                order = size_bucketed_order(
+                    np.array([sample.graph.node_features.shape[0] for sample in loaded_samples]),
+                    shuffle=self._data_fold == DataFold.TRAIN,
+                )
+                loaded_samples = [loaded_samples[i] for i in order]
+            elif self._data_fold == DataFold.TRAIN:
                 np.random.shuffle(loaded_samples)
 
-            for features, labels in self._batcher.batch(loaded_samples):
+            batches = self._batcher.batch(loaded_samples)
+            if self._bucket_by_num_nodes and self._data_fold == DataFold.TRAIN:
+                # Batches are ordered by the size of their molecules, so mix them up:
+                batches = list(batches)
+                np.random.shuffle(batches)
+            for features, labels in batches:
                 yield features, labels
-        return map(
-            partial(torchify, device=self._device),
-            iter(
-                self._dataset.get_task_reading_iterable(
-                    data_fold=self._data_fold,
-                    task_reader_fn=paths_to_mixed_samples,
-                    repeat=self._repeat,
-                    reader_chunk_size=self._num_chunked_tasks,
-                )
-            ),
+
+        host_batches: Iterator[Tuple[FSMolMultitaskBatch, np.ndarray]] = iter(
+            self._dataset.get_task_reading_iterable(
+                data_fold=self._data_fold,
+                task_reader_fn=paths_to_mixed_samples,
+                repeat=self._repeat,
+                reader_chunk_size=self._num_chunked_tasks,
+            )
         )
+        if self._device.type == "cuda":
+            if self._num_prefetched_batches > 0:
+                host_batches = ThreadedPrefetcher(
+                    host_batches, max_queue_size=self._num_prefetched_batches
+                )
+            # Copy the next batch to the GPU while the current one is being processed:
+            return DataPrefetcher(host_batches, device=self._device)
+
+        batches = map(partial(torchify, device=self._device), host_batches)
+        if self._num_prefetched_batches > 0:
+            batches = ThreadedPrefetcher(batches, max_queue_size=self._num_prefetched_batches)
+        return batches
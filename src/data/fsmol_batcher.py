@@ -32,7 +32,9 @@ class FSMolBatch:
         num_edges: total number of edges in batch; one batch contains multiple disconnected
             graphs where edges and nodes are renumbered accordingly.
         node_features: each node has a vector representation dependent on featurisation,
-            e.g. atom type, charge, valency. [V, atom_features] float, where V is number of nodes
+            e.g. atom type, charge, valency. [V, atom_features] float, where V is number of nodes.
+            Binary node features may instead be given by the indices of their active entries,
+            see node_features_to_active_ids.
         adjacency_lists: Lists of all edges in the batch, for each edge type.
             list, len num_edge_types, elements [num edges, 2] int tensors
         edge_features: edges may also have vector representation carrying information specific
@@ -59,6 +61,35 @@ BatchFeatureType = TypeVar("BatchFeatureType")
 BatchLabelType = TypeVar("BatchLabelType")
 
 
+def node_features_to_active_ids(node_features: np.ndarray) -> np.ndarray:
+    """Converts binary node features (e.g., concatenated one-hot encodings of atom properties)
+    into the indices of their active entries, which is a much more compact representation.
+
+    Args:
+        node_features: float array of shape [V, D], all entries of which are 0 or 1.
+
+    Returns:
+        unsigned int array of shape [V, K], where K is the maximal number of active entries of a
+        node. Row v holds the indices of the active entries of node v, padded with D.
+    """
+    is_active = node_features != 0
+    if not np.all(node_features[is_active] == 1):
+        raise ValueError("Only binary node features can be represented by their active entries.")
+
+    num_nodes, num_features = node_features.shape
+    num_active = is_active.sum(axis=1)
+    node_ids, feature_ids = np.nonzero(is_active)  # ordered by node
+    active_ids = np.full(
+        shape=(num_nodes, num_active.max(initial=0)),
+        fill_value=num_features,
+        dtype=np.min_scalar_type(num_features),
+    )
+    # Position of each active entry among those of its node:
+    node_offsets = np.cumsum(num_active) - num_active
+    active_ids[node_ids, np.arange(len(node_ids)) - node_offsets[node_ids]] = feature_ids
+    return active_ids
+
+
 def fsmol_batch_finalizer(batch_data: Dict[str, Any]) -> FSMolBatch:
     """
     Default implementation of a batch finalizer. Converts a batch that has reached maximum size
@@ -68,10 +99,21 @@ def fsmol_batch_finalizer(batch_data: Dict[str, Any]) -> FSMolBatch:
         batch_data: Dictionary containing batch data, initialised and populated
             from "MoleculeDatapoints" by the "FSMolBatcher.batch()" method.
     """
+    # Node ids in the per-graph adjacency lists are local to each graph; shift them by the
+    # graph's offset in the batch with a single add per edge type:
+    num_graph_nodes = np.array(batch_data["num_graph_nodes"], dtype=np.int64)
+    graph_node_offsets = np.cumsum(num_graph_nodes) - num_graph_nodes
+
     adjacency_lists = []
     for adj_lists in batch_data["adjacency_lists"]:
         if len(adj_lists) > 0:
-            adjacency_lists.append(np.concatenate(adj_lists, axis=0))
+            num_graph_edges = np.fromiter(
+                (len(adj_list) for adj_list in adj_lists), dtype=np.int64, count=len(adj_lists)
+            )
+            edge_node_offsets = np.repeat(graph_node_offsets, num_graph_edges)
+            adjacency_lists.append(
+                np.concatenate(adj_lists, axis=0) + edge_node_offsets[:, np.newaxis]
+            )
         else:
             adjacency_lists.append(np.zeros(shape=(0, 2), dtype=np.int64))
 
@@ -91,7 +133,9 @@ def fsmol_batch_finalizer(batch_data: Dict[str, Any]) -> FSMolBatch:
         node_features=np.concatenate(batch_data["node_features"], axis=0),
         adjacency_lists=adjacency_lists,
         edge_features=edge_features,
-        node_to_graph=np.concatenate(batch_data["node_to_graph"], axis=0),
+        node_to_graph=np.repeat(
+            np.arange(batch_data["num_graphs"], dtype=np.int64), num_graph_nodes
+        ),
         smiles=batch_data['smiles'], # TODO(cfifty): consider removing..
     )
 
@@ -153,7 +197,7 @@ class FSMolBatcher(Generic[BatchFeatureType, BatchLabelType]):
             "node_features": [],
             "adjacency_lists": [[] for _ in range(NUM_EDGE_TYPES)],
             "edge_features": [[] for _ in range(NUM_EDGE_TYPES)],
-            "node_to_graph": [],
+            "num_graph_nodes": [],
             "graph_task": [],
             "bool_labels": [],
             "numeric_labels": [],
@@ -196,13 +240,12 @@ class FSMolBatcher(Generic[BatchFeatureType, BatchLabelType]):
 
             # Collect the actual graph information:
             batch_data["node_features"].append(datapoint.graph.node_features)
+            # Node ids are shifted to batch-level ids once, in the finalizer:
             for edge_type, adj_list in enumerate(datapoint.graph.adjacency_lists):
-                batch_data["adjacency_lists"][edge_type].append(adj_list + batch_data["num_nodes"])
+                batch_data["adjacency_lists"][edge_type].append(adj_list)
             for edge_type, edge_feats in enumerate(datapoint.graph.edge_features):
                 batch_data["edge_features"][edge_type].append(edge_feats)
-            batch_data["node_to_graph"].append(
-                np.full(shape=(num_nodes,), fill_value=sample_id_in_batch, dtype=np.int64)
-            )
+            batch_data["num_graph_nodes"].append(num_nodes)
 
             # TODO(cfifty): Consider removing...
             batch_data['smiles'].append(datapoint.smiles)
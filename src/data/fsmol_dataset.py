@@ -123,8 +123,19 @@ class FSMolDataset:
         ] = default_reader_fn,
         repeat: bool = False,
         reader_chunk_size: int = 1,
+        num_workers: Optional[int] = None,
     ) -> Iterable[TaskReaderResultType]:
-        if self._num_workers == 0:
+        """Create an iterable over the results of task_reader_fn, applied to chunks of the task
+        files in the given fold.
+
+        Args:
+            num_workers: (Optional) number of reader processes to use, overriding the value the
+                dataset was constructed with. 0 runs task_reader_fn in the calling process.
+        """
+        if num_workers is None:
+            num_workers = self._num_workers
+
+        if num_workers == 0:
             return SequentialFileReaderIterable(
                 reader_fn=task_reader_fn,
                 data_paths=self._fold_to_data_paths[data_fold],
@@ -139,5 +150,5 @@ class FSMolDataset:
                 shuffle_data=data_fold == DataFold.TRAIN,
                 repeat=repeat,
                 reader_chunk_size=reader_chunk_size,
-                num_workers=self._num_workers,
+                num_workers=num_workers,
             )
@@ -27,6 +27,9 @@ class GraphData:
             If not present, all edge_feat_dim=0.
     """
 
+    # There is one GraphData (and MoleculeDatapoint) per molecule, so we avoid per-instance dicts:
+    __slots__ = ("node_features", "adjacency_lists", "edge_features")
+
     node_features: np.ndarray
     adjacency_lists: List[np.ndarray]
     edge_features: List[np.ndarray]
@@ -48,6 +51,16 @@ class MoleculeDatapoint:
         descriptors: optional phys-chem descriptors for the molecule.
     """
 
+    __slots__ = (
+        "task_name",
+        "smiles",
+        "graph",
+        "numeric_label",
+        "bool_label",
+        "fingerprint",
+        "descriptors",
+    )
+
     task_name: str
     smiles: str
     graph: GraphData
@@ -56,6 +69,14 @@ class MoleculeDatapoint:
     fingerprint: Optional[np.ndarray]
     descriptors: Optional[np.ndarray]
 
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state) -> None:
+        # Unpickling would otherwise restore slots through setattr, which frozen dataclasses forbid:
+        for name, value in zip(self.__slots__, state):
+            object.__setattr__(self, name, value)
+
     def get_fingerprint(self) -> np.ndarray:
         if self.fingerprint is not None:
             return self.fingerprint
@@ -0,0 +1,92 @@
+import gzip
+import json
+
+import numpy as np
+import pytest
+from dpu_utils.utils import RichPath
+
+from data.binding_affinity_task import BindingAffinityTask
+
+
+def _write_samples(path, samples) -> RichPath:
+    with gzip.open(path, "wt") as f:
+        for sample in samples:
+            f.write(json.dumps(sample) + "\n")
+    return RichPath.create(str(path))
+
+
+def test_load_graphs_without_atoms_or_edge_features(tmp_path):
+    path = _write_samples(
+        tmp_path / "task.jsonl.gz",
+        [
+            {
+                "SMILES": "",
+                "graph": {"adjacency_lists": [[], []], "node_features": []},
+                "RegressionProperty": 1.0,
+            },
+            {
+                "SMILES": "CC",
+                "graph": {
+                    "adjacency_lists": [[[0, 1]], []],
+                    "node_features": [[1, 0], [0, 1]],
+                    "edge_features": [[[0.5, 1.5, 2.0]], []],
+                },
+                "RegressionProperty": 2.0,
+            },
+            {
+                "SMILES": "CCC",
+                "graph": {
+                    "adjacency_lists": [[[0, 1], [1, 2]], [[0, 2]]],
+                    "node_features": [[1, 0], [0, 1], [1, 1]],
+                },
+                "RegressionProperty": 3.0,
+            },
+        ],
+    )
+    empty_graph, graph_with_edge_features, graph_without_edge_features = [
+        sample.graph for sample in BindingAffinityTask.load_from_file(path).samples
+    ]
+
+    assert empty_graph.node_features.shape == (0, 2)
+    assert [e.shape for e in empty_graph.edge_features] == [(0, 0), (0, 0)]
+
+    np.testing.assert_array_equal(graph_with_edge_features.node_features, [[1, 0], [0, 1]])
+    np.testing.assert_array_equal(graph_with_edge_features.edge_features[0], [[0.5, 1.5, 2.0]])
+
+    # One (zero-width) row of edge features per edge:
+    assert [e.shape for e in graph_without_edge_features.edge_features] == [(2, 0), (1, 0)]
+
+
+def test_load_missing_scores_as_nan(tmp_path):
+    graph = {"adjacency_lists": [[[0, 1]]], "node_features": [[1, 0], [0, 1]]}
+    path = _write_samples(
+        tmp_path / "task.jsonl.gz",
+        [
+            {"SMILES": "CC", "graph": graph, "RegressionProperty": None},
+            {"SMILES": "CC", "graph": graph},
+            {"SMILES": "CC", "graph": graph, "RegressionProperty": 0.0},
+            {"SMILES": "CC", "graph": graph, "RegressionProperty": -7.5},
+        ],
+    )
+    labels = [sample.numeric_label for sample in BindingAffinityTask.load_from_file(path).samples]
+    np.testing.assert_array_equal(labels, [np.nan, np.nan, 0.0, -7.5])
+
+
+def test_serialized_nan_scores_load_as_nan(tmp_path):
+    pytest.importorskip("rdkit")
+    from preprocessing.process_binding_scores import serialize
+
+    (tmp_path / "train").mkdir()
+    graph = {"adjacency_lists": [[[0, 1]]], "node_features": [[1, 0], [0, 1]]}
+    serialize(
+        {
+            "task": [
+                {"SMILES": "CC", "graph": graph, "RegressionProperty": float("nan")},
+                {"SMILES": "CC", "graph": graph, "RegressionProperty": -7.5},
+            ]
+        },
+        str(tmp_path),
+    )
+    path = RichPath.create(str(tmp_path / "train" / "task.jsonl.gz"))
+    task = BindingAffinityTask.load_from_file(path)
+    np.testing.assert_array_equal([sample.numeric_label for sample in task.samples], [np.nan, -7.5])
@@ -0,0 +1,94 @@
+import gzip
+import json
+
+import numpy as np
+import pytest
+import torch
+from dpu_utils.utils import RichPath
+
+from data.binding_data_multitask import MultitaskTaskSampleBatchIterable
+from data.fsmol_dataset import NUM_NODE_FEATURES, DataFold, FSMolDataset
+
+
+def _write_task(path, num_molecules: int, seed: int) -> None:
+    rng = np.random.default_rng(seed)
+    with gzip.open(path, "wt") as f:
+        for _ in range(num_molecules):
+            num_nodes = int(rng.integers(2, 8))
+            node_features = np.zeros((num_nodes, NUM_NODE_FEATURES))
+            node_features[np.arange(num_nodes), rng.integers(0, NUM_NODE_FEATURES, num_nodes)] = 1.0
+            graph = {
+                "adjacency_lists": [[[i, i + 1] for i in range(num_nodes - 1)], [], []],
+                "node_features": node_features.tolist(),
+            }
+            datapoint = {
+                "SMILES": "C" * num_nodes,
+                "graph": graph,
+                "RegressionProperty": float(rng.normal()),
+            }
+            f.write(json.dumps(datapoint) + "\n")
+
+
+@pytest.fixture
+def dataset(tmp_path) -> FSMolDataset:
+    paths = []
+    for i, task_name in enumerate(["task_a", "task_b"]):
+        path = tmp_path / f"{task_name}.jsonl.gz"
+        # The iterable samples 1024 molecules from each task:
+        _write_task(path, num_molecules=1100, seed=i)
+        paths.append(RichPath.create(str(path)))
+    return FSMolDataset(valid_data_paths=paths, num_workers=0)
+
+
+def _collect_batches(dataset: FSMolDataset, num_prefetched_batches: int):
+    iterable = MultitaskTaskSampleBatchIterable(
+        dataset,
+        data_fold=DataFold.VALIDATION,
+        task_name_to_id={"task_a": 0, "task_b": 1},
+        device=torch.device("cpu"),
+        max_num_graphs=256,
+        num_chunked_tasks=2,
+        num_prefetched_batches=num_prefetched_batches,
+    )
+    # The reader shuffles the order of the task files:
+    np.random.seed(0)
+    return list(iterable)
+
+
+@pytest.mark.parametrize("num_prefetched_batches", [0, 2])
+def test_iterate_with_and_without_prefetching(dataset, num_prefetched_batches):
+    batches = _collect_batches(dataset, num_prefetched_batches)
+    assert len(batches) > 0
+
+    reference_batches = _collect_batches(dataset, num_prefetched_batches=1)
+    assert len(batches) == len(reference_batches)
+    for (features, labels), (ref_features, ref_labels) in zip(batches, reference_batches):
+        assert isinstance(labels, torch.Tensor)
+        assert torch.equal(labels, ref_labels)
+        assert torch.equal(features.node_features, ref_features.node_features)
+        assert torch.equal(features.node_to_graph, ref_features.node_to_graph)
+
+
+def test_stop_iterating_early(dataset):
+    iterable = MultitaskTaskSampleBatchIterable(
+        dataset,
+        data_fold=DataFold.VALIDATION,
+        task_name_to_id={"task_a": 0, "task_b": 1},
+        device=torch.device("cpu"),
+        max_num_graphs=64,
+        num_chunked_tasks=2,
+        num_prefetched_batches=1,
+    )
+    batches = iter(iterable)
+    for _ in batches:
+        # The background thread is now blocked on the full queue:
+        break
+    batches.close()
+    assert not batches._thread.is_alive()
+
+    # Dropping the iterator without closing it stops the background thread as well:
+    batches = iter(iterable)
+    next(batches)
+    thread = batches._thread
+    del batches
+    assert not thread.is_alive()
@@ -6,8 +6,9 @@ import os
 import sys
 import time
 from abc import abstractclassmethod, abstractmethod
-from functools import partial
+from functools import cached_property, partial
 from typing import (
+    FrozenSet,
     Tuple,
     Dict,
     Optional,
@@ -63,10 +64,6 @@ ModelStateType = Dict[str, Any]
 class AbstractTorchFSMolModel(
     Generic[BatchFeaturesType, BatchOutputType, BatchLossType], torch.nn.Module
 ):
-    def __init__(self):
-        super().__init__()
-        self.criterion = torch.nn.MSELoss(reduction='none')
-
     @abstractmethod
     def forward(self, batch: BatchFeaturesType) -> BatchOutputType:
         """
@@ -96,8 +93,9 @@ class AbstractTorchFSMolModel(
         Returns:
             Dictionary mapping partial loss names to the loss. Optimization will be performed over the sum of values.
         """
-        predictions = model_output.molecule_binary_label.squeeze(dim=-1)
-        label_loss = self.criterion(predictions, labels.float())
+        # Under autocast, predictions may be in reduced precision; compute the loss in float32:
+        predictions = model_output.molecule_binary_label.squeeze(dim=-1).float()
+        label_loss = torch.nn.functional.mse_loss(predictions, labels.float(), reduction="none")
         mean_loss = torch.mean(label_loss)
         return TorchFSMolModelLoss(label_loss=mean_loss), label_loss
 
@@ -134,6 +132,15 @@ class AbstractTorchFSMolModel(
     def is_param_task_specific(self, param_name: str) -> bool:
         raise NotImplementedError()
 
+    @cached_property
+    def task_specific_param_names(self) -> FrozenSet[str]:
+        """Names of all parameters for which is_param_task_specific holds, computed once."""
+        return frozenset(
+            param_name
+            for param_name, _ in self.named_parameters()
+            if self.is_param_task_specific(param_name)
+        )
+
     @abstractclassmethod
     def build_from_model_file(
             cls,
@@ -160,18 +167,28 @@ def create_optimizer(
         task_specific_warmup_steps: int = 100,
 ) -> Tuple[torch.optim.Optimizer, torch.optim.lr_scheduler._LRScheduler]:
     # Split parameters into shared and task-specific ones:
+    task_specific_param_names = model.task_specific_param_names
     shared_parameters, task_spec_parameters = [], []
     for param_name, param in model.named_parameters():
-        if model.is_param_task_specific(param_name):
+        if param_name in task_specific_param_names:
             task_spec_parameters.append(param)
         else:
             shared_parameters.append(param)
 
+    # The model consists of many small tensors, so update them with as few kernel launches as
+    # possible: the fused Adam kernel is only available on CUDA, elsewhere use the multi-tensor
+    # (foreach) implementation:
+    if next(model.parameters()).device.type == "cuda":
+        adam_impl_kwargs = {"fused": True}
+    else:
+        adam_impl_kwargs = {"foreach": True}
+
     opt = torch.optim.Adam(
         [
             {"params": task_spec_parameters, "lr": task_specific_lr},
             {"params": shared_parameters, "lr": lr},
         ],
+        **adam_impl_kwargs,
     )
 
     scheduler = torch.optim.lr_scheduler.LambdaLR(
@@ -250,6 +267,9 @@ def run_on_data_iterable(
         quiet: bool = False,
         metric_name_prefix: str = "",
         aml_run=None,
+        autocast_dtype: Optional[torch.dtype] = None,
+        grad_scaler: Optional[torch.amp.GradScaler] = None,
+        mark_cudagraph_steps: bool = False,
 ) -> float:
     """Run the given model on the provided data loader.
 
@@ -260,11 +280,17 @@ def run_on_data_iterable(
         optimizer: Optional optimizer. If present, the given model will be trained.
         lr_scheduler: Optional learning rate scheduler around optimizer.
         max_num_steps: Optional number of steps. If not provided, will run until end of data loader.
+        autocast_dtype: Optional reduced precision dtype (e.g., torch.bfloat16) in which to run
+            the forward pass. If not provided, everything runs in float32.
+        grad_scaler: Optional gradient scaler, required to train with torch.float16.
+        mark_cudagraph_steps: Whether to mark the start of each step for the CUDA graphs that
+            torch.compile records in mode "reduce-overhead". Only set this for such models.
     """
     if optimizer is None:
         model.eval()
     else:
         model.train()
+    device_type = next(model.parameters()).device.type
 
     metric_logger = MetricLogger(
         log_fn=lambda msg: logger.log(PROGRESS_LOG_LEVEL, msg),
@@ -272,23 +298,45 @@ def run_on_data_iterable(
         quiet=quiet,
         metric_name_prefix=metric_name_prefix,
     )
-    for batch_idx, (batch, labels) in enumerate(iter(data_iterable)):
+    # Batches are small, so avoid repeating lookups (and walking the module tree to find the
+    # parameters for clipping) in every step:
+    model_compute_loss = model.compute_loss
+    log_metrics = metric_logger.log_metrics
+    parameters = list(model.parameters())
+    for batch_idx, (batch, labels) in enumerate(data_iterable):
         if max_num_steps is not None and batch_idx >= max_num_steps:
             break
 
+        if mark_cudagraph_steps:
+            # Tell CUDA graphs recorded by torch.compile (mode "reduce-overhead") that a new
+            # training step starts, so that they can reuse the memory of the previous step. Batches
+            # are not padded, so most steps have a new shape and record a graph rather than replay.
+            torch.compiler.cudagraph_mark_step_begin()
+
         if optimizer is not None:
-            optimizer.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
 
-        predictions: BatchOutputType = model(batch)
-        model_loss, label_loss = model.compute_loss(batch, predictions, labels)
-        metric_logger.log_metrics(**model_loss.metrics_to_log)
+        with torch.autocast(
+            device_type=device_type, dtype=autocast_dtype, enabled=autocast_dtype is not None
+        ):
+            predictions: BatchOutputType = model(batch)
+            model_loss, label_loss = model_compute_loss(batch, predictions, labels)
+        log_metrics(**model_loss.metrics_to_log)
 
         # Training step:
         if optimizer is not None:
             loss = model_loss.total_loss
-            loss.backward()
-            torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
-            optimizer.step()
+            if grad_scaler is not None:
+                grad_scaler.scale(loss).backward()
+                # Gradients need to be unscaled before clipping:
+                grad_scaler.unscale_(optimizer)
+                torch.nn.utils.clip_grad_norm_(parameters, 1.0, foreach=True)
+                grad_scaler.step(optimizer)
+                grad_scaler.update()
+            else:
+                loss.backward()
+                torch.nn.utils.clip_grad_norm_(parameters, 1.0, foreach=True)
+                optimizer.step()
         if lr_scheduler is not None:
             lr_scheduler.step()
     return metric_logger.get_mean_metric_value("total_loss")
@@ -297,19 +345,31 @@ def run_on_data_iterable(
 def compute_loss(
         model: AbstractTorchFSMolModel[BatchFeaturesType, BatchOutputType, BatchLossType],
         data_iterable: Iterable[Tuple[BatchFeaturesType, torch.Tensor]],
+        autocast_dtype: Optional[torch.dtype] = None,
+        mark_cudagraph_steps: bool = False,
 ) -> float:
     model.eval()
+    device_type = next(model.parameters()).device.type
     metric_logger = MetricLogger(
         log_fn=lambda msg: logger.log(PROGRESS_LOG_LEVEL, msg),
         aml_run=None,
         quiet=True,
         metric_name_prefix="",
     )
-    for batch_idx, (batch, labels) in enumerate(iter(data_iterable)):
-        predictions: BatchOutputType = model(batch)
-        model_loss, _ = model.compute_loss(batch, predictions, labels)
-        metric_logger.log_metrics(**model_loss.metrics_to_log)
-    return metric_logger.get_mean_metric_value("total_loss")
+    # No gradients are needed here, so do not record the autograd graph:
+    model_compute_loss = model.compute_loss
+    log_metrics = metric_logger.log_metrics
+    with torch.inference_mode():
+        for batch, labels in data_iterable:
+            if mark_cudagraph_steps:
+                torch.compiler.cudagraph_mark_step_begin()
+            with torch.autocast(
+                device_type=device_type, dtype=autocast_dtype, enabled=autocast_dtype is not None
+            ):
+                predictions: BatchOutputType = model(batch)
+                model_loss, _ = model_compute_loss(batch, predictions, labels)
+            log_metrics(**model_loss.metrics_to_log)
+        return metric_logger.get_mean_metric_value("total_loss")
 
 
 def train_loop(
@@ -322,12 +382,20 @@ def train_loop(
         patience: int = 5,
         aml_run=None,
         quiet: bool = False,
+        autocast_dtype: Optional[torch.dtype] = None,
+        mark_cudagraph_steps: bool = False,
 ) -> Tuple[float, ModelStateType]:
     if quiet:
         log_level = logging.DEBUG
     else:
         log_level = logging.INFO
 
+    # float16 has a small range, so losses need to be scaled to avoid underflowing gradients:
+    if autocast_dtype == torch.float16:
+        grad_scaler: Optional[torch.amp.GradScaler] = torch.amp.GradScaler("cuda")
+    else:
+        grad_scaler = None
+
     valid_losses = []
     train_losses = []
 
@@ -342,6 +410,9 @@ def train_loop(
             quiet=quiet,
             metric_name_prefix="train_",
             aml_run=aml_run,
+            autocast_dtype=autocast_dtype,
+            grad_scaler=grad_scaler,
+            mark_cudagraph_steps=mark_cudagraph_steps,
         )
 
         train_losses.append(train_loss)
@@ -349,7 +420,12 @@ def train_loop(
         logger.log(log_level, f"  Mean train loss: {train_loss:.5f}")
 
         logger.log(log_level, f"  = Validation")
-        valid_loss = compute_loss(model, valid_data)
+        valid_loss = compute_loss(
+            model,
+            valid_data,
+            autocast_dtype=autocast_dtype,
+            mark_cudagraph_steps=mark_cudagraph_steps,
+        )
         print(f'Valid Loss: {valid_loss:.4f}')
         valid_losses.append(valid_loss)
 
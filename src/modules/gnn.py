@@ -1,10 +1,10 @@
 import argparse
 from dataclasses import dataclass
-from typing import List, Optional, Union
+from typing import List, Optional
 
 import torch
 import torch.nn as nn
-from torch_scatter import scatter_sum, scatter_log_softmax, scatter_mean, scatter_max
+from torch_scatter import gather_csr, scatter_sum, scatter_log_softmax, segment_csr
 
 from data.fsmol_dataset import NUM_EDGE_TYPES
 from modules.mlp import MLP
@@ -28,6 +28,42 @@ class GNNConfig:
     make_edges_bidirectional: bool = True
 
 
+@dataclass
+class IncomingEdges:
+    """Incoming edges of all nodes, across all edge types, in compressed sparse row (CSR) form.
+
+    Messages are computed per edge type, in the order given by concatenating the adjacency lists.
+    Reordering them by message_order groups them by target node, such that the messages to node
+    v are found at positions target_ptr[v]:target_ptr[v+1]. This allows to aggregate messages by
+    segment reductions instead of scatters.
+
+    Args:
+        targets: int tensor of shape [E], target node of each message, in concatenation order.
+        message_order: int tensor of shape [E], stable permutation sorting targets.
+        target_ptr: int tensor of shape [V + 1], offsets of each node's messages after sorting.
+    """
+
+    targets: torch.Tensor
+    message_order: torch.Tensor
+    target_ptr: torch.Tensor
+
+    @staticmethod
+    def from_adjacency_lists(adj_lists: List[torch.Tensor], num_nodes: int) -> "IncomingEdges":
+        targets = torch.cat([adj_list[:, 1] for adj_list in adj_lists], dim=0)
+        sorted_targets, message_order = torch.sort(targets, stable=True)
+        # Messages to node v start after all messages to nodes < v. Unlike bincount, searchsorted
+        # does not need to synchronise with the host, so this can be captured in CUDA graphs:
+        target_ptr = torch.searchsorted(
+            sorted_targets,
+            torch.arange(num_nodes + 1, dtype=sorted_targets.dtype, device=sorted_targets.device),
+        )
+        return IncomingEdges(targets=targets, message_order=message_order, target_ptr=target_ptr)
+
+    @property
+    def node_degrees(self) -> torch.Tensor:
+        return self.target_ptr[1:] - self.target_ptr[:-1]
+
+
 def add_gnn_model_arguments(parser: argparse.ArgumentParser):
     parser.add_argument(
         "--gnn_type",
@@ -130,9 +166,12 @@ class RelationalMP(nn.Module):
         self,
         x: torch.Tensor,
         adj_lists: List[torch.Tensor],
+        incoming_edges: Optional[IncomingEdges] = None,
     ):
+        if incoming_edges is None:
+            incoming_edges = IncomingEdges.from_adjacency_lists(adj_lists, num_nodes=x.shape[0])
+
         all_msg_list: List[torch.Tensor] = []  # all messages exchanged between nodes
-        all_tgts_list: List[torch.Tensor] = []  # [E] - list of targets for all messages
 
         for edge_type, adj_list in enumerate(adj_lists):
             srcs = adj_list[:, 0]
@@ -142,24 +181,21 @@ class RelationalMP(nn.Module):
             messages = nn.functional.relu(messages)
 
             all_msg_list.append(messages)
-            all_tgts_list.append(tgts)
 
-        all_messages = torch.cat(all_msg_list, dim=0)  # [E, msg_dim]
-        all_targets = torch.cat(all_tgts_list, dim=0)  # [E]
+        # [E, msg_dim], grouped by target node:
+        all_messages = torch.cat(all_msg_list, dim=0)[incoming_edges.message_order]
 
-        return self._aggregate_messages(all_messages, all_targets, num_nodes=x.shape[0])
+        return self._aggregate_messages(all_messages, incoming_edges)
 
     def _aggregate_messages(
         self,
         messages: torch.Tensor,
-        targets: torch.Tensor,
-        num_nodes: Union[torch.Tensor, int],
+        incoming_edges: IncomingEdges,
     ):
-        aggregated_messages = scatter_sum(
+        aggregated_messages = segment_csr(
             src=messages,
-            index=targets,
-            dim=0,
-            dim_size=num_nodes,
+            indptr=incoming_edges.target_ptr,
+            reduce="sum",
         )  # [V, msg_dim]
 
         return aggregated_messages
@@ -197,37 +233,36 @@ class RelationalMultiAggrMP(RelationalMP):
     def _aggregate_messages(
         self,
         messages: torch.Tensor,
-        targets: torch.Tensor,
-        num_nodes: Union[torch.Tensor, int],
+        incoming_edges: IncomingEdges,
     ):
-        sum_aggregated_messages = scatter_sum(
-            src=messages[:, : self.partial_msg_dim],
-            index=targets,
-            dim=0,
-            dim_size=num_nodes,
-        )  # [V, partial_msg_dim]
+        node_degrees = incoming_edges.node_degrees  # [V]
+
+        # Sum up the messages used for the sum and mean aggregation in one go:
+        summed_messages = segment_csr(
+            src=messages[:, : 2 * self.partial_msg_dim],
+            indptr=incoming_edges.target_ptr,
+            reduce="sum",
+        )  # [V, 2 * partial_msg_dim]
+        sum_aggregated_messages = summed_messages[:, : self.partial_msg_dim]
         mean_messages = messages[:, self.partial_msg_dim : 2 * self.partial_msg_dim]
-        mean_aggregated_messages = scatter_mean(
-            src=mean_messages,
-            index=targets,
-            dim=0,
-            dim_size=num_nodes,
-        )  # [V, partial_msg_dim]
+        mean_aggregated_messages = summed_messages[:, self.partial_msg_dim :] / node_degrees.clamp(
+            min=1
+        ).unsqueeze(-1)  # [V, partial_msg_dim]
         per_node_message_stdev = (
-            nn.functional.relu(mean_messages.pow(2) - mean_aggregated_messages[targets].pow(2))
+            nn.functional.relu(
+                mean_messages.pow(2)
+                - gather_csr(mean_aggregated_messages, incoming_edges.target_ptr).pow(2)
+            )
             + SMALL_NUMBER
         )
         std_aggregated_messages = torch.sqrt(
-            scatter_sum(src=per_node_message_stdev, index=targets, dim=0, dim_size=num_nodes)
+            segment_csr(src=per_node_message_stdev, indptr=incoming_edges.target_ptr, reduce="sum")
         )  # [V, partial_msg_dim]
-        max_aggregated_messages = scatter_max(
+        max_aggregated_messages = segment_csr(
             src=messages[:, 2 * self.partial_msg_dim : 3 * self.partial_msg_dim],
-            index=targets,
-            dim=0,
-            dim_size=num_nodes,
-        )[
-            0
-        ]  # [V, partial_msg_dim]  # [0] needed to strip out the indices of the max.
+            indptr=incoming_edges.target_ptr,
+            reduce="max",
+        )  # [V, partial_msg_dim]
 
         messages = torch.cat(
             (
@@ -240,12 +275,6 @@ class RelationalMultiAggrMP(RelationalMP):
         )
 
         if self.use_pna_scalers:
-            # First, compute degrees of nodes:
-            node_degrees = scatter_sum(
-                torch.ones_like(targets),
-                index=targets,
-                dim_size=num_nodes,
-            )
             delta = 1.1515  # Computed over LSC dataset
 
             log_node_degrees = torch.log(node_degrees.float() + 1).unsqueeze(-1)
@@ -316,10 +345,13 @@ class RelationalMultiHeadAttentionMP(nn.Module):
         self,
         x: torch.Tensor,
         adj_lists: List[torch.Tensor],
+        incoming_edges: Optional[IncomingEdges] = None,
     ):
+        if incoming_edges is None:
+            incoming_edges = IncomingEdges.from_adjacency_lists(adj_lists, num_nodes=x.shape[0])
+
         all_msg_list: List[torch.Tensor] = []  # all messages exchanged between nodes
         all_scores_list: List[torch.Tensor] = []  # attention scores for all messages
-        all_tgts_list: List[torch.Tensor] = []  # [E] - list of targets for all messages
 
         for edge_type, adj_list in enumerate(adj_lists):
             srcs = adj_list[:, 0]
@@ -360,11 +392,10 @@ class RelationalMultiHeadAttentionMP(nn.Module):
 
             all_msg_list.append(messages)  # [E_i, num_heads, head_dim]
             all_scores_list.append(edge_scores)  # [E_i, num_heads]
-            all_tgts_list.append(tgts)
 
         all_messages = torch.cat(all_msg_list, dim=0)  # [E, num_heads, head_dim]
         all_scores = torch.cat(all_scores_list, dim=0)  # [E, num_heads]
-        all_targets = torch.cat(all_tgts_list, dim=0)  # [E]
+        all_targets = incoming_edges.targets  # [E]
 
         # Compute attention scores per head:
         all_probs = torch.exp(
@@ -478,14 +509,21 @@ class GNNBlock(nn.Module):
         self,
         node_representations,
         adj_lists,
+        incoming_edges: Optional[IncomingEdges] = None,
     ):
         """
         Args:
             node_representations: float tensor of shape (num_nodes, config.hidden_dim)
             adj_lists: List of (num_edges, 2) tensors (one per edge-type)
+            incoming_edges: (Optional) CSR form of adj_lists, computed from them if not provided.
         Returns:
             node_representations: float (num_graphs, config.hidden_dim) tensor
         """
+        if incoming_edges is None:
+            incoming_edges = IncomingEdges.from_adjacency_lists(
+                adj_lists, num_nodes=node_representations.shape[0]
+            )
+
         aggregated_messages = []
         for i, mp_layer in enumerate(self.mp_layers):
             sliced_node_representations = node_representations[
@@ -495,6 +533,7 @@ class GNNBlock(nn.Module):
                 mp_layer(
                     x=sliced_node_representations,
                     adj_lists=adj_lists,
+                    incoming_edges=incoming_edges,
                 )
             )
 
@@ -543,6 +582,11 @@ class GNN(nn.Module):
                 for adj_list in adj_lists
             ]
 
+        # The edges are the same in all layers, so group them by target node only once:
+        incoming_edges = IncomingEdges.from_adjacency_lists(
+            adj_lists, num_nodes=node_features.shape[0]
+        )
+
         # Actually do message passing:
         cur_node_representations = node_features
         all_node_representations: List[torch.Tensor] = [cur_node_representations]
@@ -550,6 +594,7 @@ class GNN(nn.Module):
             cur_node_representations = gnn_block(
                 node_representations=cur_node_representations,
                 adj_lists=adj_lists,
+                incoming_edges=incoming_edges,
             )
             all_node_representations.append(cur_node_representations)
 
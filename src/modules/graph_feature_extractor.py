@@ -73,16 +73,34 @@ class GraphFeatureExtractor(nn.Module):
                 num_features=self.config.readout_config.output_dim
             )
 
+    def _project_node_features(self, node_features: torch.Tensor) -> torch.Tensor:
+        if node_features.is_floating_point():
+            # Node features may be stored in reduced precision, so upcast them first:
+            return self.init_node_proj(node_features.to(self.init_node_proj.weight.dtype))
+
+        # Binary node features given by the indices of their active entries, padded with
+        # initial_node_feature_dim (see node_features_to_active_ids). Projecting them means summing
+        # up the weights of the active entries, with an extra zero row for the padding:
+        padded_weight = nn.functional.pad(self.init_node_proj.weight.t(), (0, 0, 0, 1))
+        return nn.functional.embedding_bag(
+            node_features.long(),
+            padded_weight,
+            mode="sum",
+            padding_idx=self.config.initial_node_feature_dim,
+        )
+
     def forward(self, input: FSMolBatch) -> torch.Tensor:
         # ----- Initial (per-node) layer:
-        initial_node_features = self.init_node_proj(input.node_features)
+        initial_node_features = self._project_node_features(input.node_features)
 
         # ----- Message passing layers:
         all_node_representations = self.gnn(initial_node_features, input.adjacency_lists)
 
         # ----- Readout phase:
         if self.config.readout_config.use_all_states:
-            readout_node_reprs = torch.cat(all_node_representations, dim=-1)
+            # The readout consumes the per-layer representations as chunks of their concatenation,
+            # so that we never need to materialise the concatenation itself:
+            readout_node_reprs = all_node_representations
         else:
             readout_node_reprs = all_node_representations[-1]
 
@@ -107,6 +125,25 @@ class MATFeatureExtractor(GraphFeatureExtractor):
             self.config.readout_config,
             128,  # Override this value because we're taking only the final layer node embeddings: not over all layers.
         )
+        # [num_graphs, nodes_per_graph] graph ids of the padded nodes, reused while the batch shape
+        # stays the same:
+        self.register_buffer("_node_to_graph_cache", None, persistent=False)
+
+    def _get_node_to_graph(
+        self, num_graphs: int, nodes_per_graph: int, device: torch.device
+    ) -> torch.Tensor:
+        cache = self._node_to_graph_cache
+        if (
+            cache is None
+            or cache.shape != (num_graphs, nodes_per_graph)
+            or cache.device != device
+            # A cache created under inference mode cannot be used in autograd:
+            or (cache.is_inference() and not torch.is_inference_mode_enabled())
+        ):
+            cache = torch.arange(num_graphs, device=device).repeat_interleave(nodes_per_graph)
+            cache = cache.view(num_graphs, nodes_per_graph)
+            self._node_to_graph_cache = cache
+        return cache.view(-1)
 
     def forward(self, input: FSMolBatch) -> torch.Tensor:
         # ----- Message passing layers:
@@ -116,8 +153,10 @@ class MATFeatureExtractor(GraphFeatureExtractor):
         num_graphs = all_node_representations.shape[0]
         nodes_per_graph = all_node_representations.shape[1]
         all_node_representations = torch.reshape(all_node_representations, (num_graphs * nodes_per_graph, -1))
-        node_to_graph = torch.repeat_interleave(
-            torch.arange(nodes_per_graph, device=f'cuda:{all_node_representations.get_device()}'), num_graphs)
+        # Rows are graph-major after the reshape, so node i belongs to graph i // nodes_per_graph:
+        node_to_graph = self._get_node_to_graph(
+            num_graphs, nodes_per_graph, all_node_representations.device
+        )
 
         mol_representations = self.readout(
             node_embeddings=all_node_representations,
@@ -1,16 +1,22 @@
 from abc import ABC, abstractmethod
 import argparse
 from dataclasses import dataclass
+from typing import List, Union
 from typing_extensions import Literal
 
 import torch
 import torch.nn as nn
 from torch_scatter import scatter_softmax, scatter
 
-from modules.mlp import MLP
+from modules.mlp import MLP, chunked_linear
 from utils.cli_utils import str2bool
 
 
+# Node representations, either as one tensor or as a list of tensors whose concatenation along
+# the last dimension gives the node representations (e.g., one per GNN layer):
+NodeEmbeddingsType = Union[torch.Tensor, List[torch.Tensor]]
+
+
 @dataclass(frozen=True)
 class GraphReadoutConfig:
     readout_type: Literal[
@@ -98,14 +104,15 @@ class GraphReadout(nn.Module, ABC):
     @abstractmethod
     def forward(
         self,
-        node_embeddings: torch.Tensor,
+        node_embeddings: NodeEmbeddingsType,
         node_to_graph_id: torch.Tensor,
         num_graphs: int,
     ) -> torch.Tensor:
         """
         Args:
             node_embeddings: representations of individual graph nodes. A float tensor
-                of shape [num_nodes, self.node_dim].
+                of shape [num_nodes, self.node_dim], or a list of float tensors of shape
+                [num_nodes, D_i] with sum_i D_i = self.node_dim, to be read as their concatenation.
             node_to_graph_id: int tensor of shape [num_nodes], assigning a graph_id to each
                 node.
             num_graphs: int scalar, giving the number of graphs in the batch.
@@ -163,7 +170,7 @@ class CombinedGraphReadout(GraphReadout):
 
     def forward(
         self,
-        node_embeddings: torch.Tensor,
+        node_embeddings: NodeEmbeddingsType,
         node_to_graph_id: torch.Tensor,
         num_graphs: int,
     ) -> torch.Tensor:
@@ -225,7 +232,7 @@ class MultiHeadWeightedGraphReadout(GraphReadout):
 
     def forward(
         self,
-        node_embeddings: torch.Tensor,
+        node_embeddings: NodeEmbeddingsType,
         node_to_graph_id: torch.Tensor,
         num_graphs: int,
     ) -> torch.Tensor:
@@ -247,7 +254,8 @@ class MultiHeadWeightedGraphReadout(GraphReadout):
         weighted_values = weights.unsqueeze(-1) * values  # [V, num_heads, head_dim]
         per_graph_values = torch.zeros(
             (num_graphs, self._num_heads * self._head_dim),
-            device=node_embeddings.device,
+            dtype=weighted_values.dtype,
+            device=weighted_values.device,
         )
         per_graph_values.index_add_(
             0,
@@ -282,18 +290,25 @@ class UnweightedGraphReadout(GraphReadout):
 
     def forward(
         self,
-        node_embeddings: torch.Tensor,
+        node_embeddings: NodeEmbeddingsType,
         node_to_graph_id: torch.Tensor,
         num_graphs: int,
     ) -> torch.Tensor:
-        per_graph_values = scatter(
-            src=node_embeddings,
-            index=node_to_graph_id,
-            dim=0,
-            dim_size=num_graphs,
-            reduce=self._pooling_type,
-        )  # [num_graphs, self.pooling_input_dim]
-        return self._combination_layer(per_graph_values)  # [num_graphs, out_dim]
+        if isinstance(node_embeddings, torch.Tensor):
+            node_embeddings = [node_embeddings]
+
+        # Pooling is per feature, so we can pool each chunk separately:
+        per_graph_values = [
+            scatter(
+                src=node_embeddings_chunk,
+                index=node_to_graph_id,
+                dim=0,
+                dim_size=num_graphs,
+                reduce=self._pooling_type,
+            )  # [num_graphs, D_i]
+            for node_embeddings_chunk in node_embeddings
+        ]
+        return chunked_linear(self._combination_layer, per_graph_values)  # [num_graphs, out_dim]
 
 
 def make_readout_model(
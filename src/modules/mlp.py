@@ -1,8 +1,27 @@
-from typing import List
+from itertools import islice
+from typing import List, Union
 
+import torch
 import torch.nn as nn
 
 
+def chunked_linear(linear: nn.Linear, input_chunks: List[torch.Tensor]) -> torch.Tensor:
+    """Computes linear(torch.cat(input_chunks, dim=-1)) without materialising the concatenation.
+
+    Args:
+        linear: Linear layer whose input dimension is the sum of the chunks' last dimensions.
+        input_chunks: float tensors of shape [V, D_i], splitting the input along its last dimension.
+
+    Returns:
+        float tensor of shape [V, linear.out_features]
+    """
+    weight_chunks = linear.weight.split([chunk.shape[-1] for chunk in input_chunks], dim=-1)
+    result = nn.functional.linear(input_chunks[0], weight_chunks[0], linear.bias)
+    for input_chunk, weight_chunk in zip(input_chunks[1:], weight_chunks[1:]):
+        result = torch.addmm(result, input_chunk, weight_chunk.t())
+    return result
+
+
 class MLP(nn.Module):
     def __init__(
         self, input_dim: int, out_dim: int, hidden_layer_dims: List[int], activation=nn.ReLU()
@@ -18,5 +37,12 @@ class MLP(nn.Module):
         layers.append(nn.Linear(cur_hidden_dim, out_dim))
         self._layers = nn.Sequential(*layers)
 
-    def forward(self, inputs):
-        return self._layers(inputs)
+    def forward(self, inputs: Union[torch.Tensor, List[torch.Tensor]]):
+        if isinstance(inputs, torch.Tensor):
+            return self._layers(inputs)
+
+        # Inputs are split along the feature dimension; only the first layer sees them:
+        outputs = chunked_linear(self._layers[0], inputs)
+        for layer in islice(self._layers, 1, None):
+            outputs = layer(outputs)
+        return outputs
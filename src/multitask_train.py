@@ -37,6 +37,15 @@ To test on a large version of the ignite_dataset:
 def add_model_arguments(parser: argparse.ArgumentParser):
     add_graph_feature_extractor_arguments(parser)
     parser.add_argument("--num_tail_layers", type=int, default=2)
+    parser.add_argument(
+        "--compile-mode",
+        type=str,
+        choices=["off", "default", "reduce-overhead", "max-autotune"],
+        default="off",
+        help="If not off, compile the model's forward pass with torch.compile in this mode. Note that "
+        "batches are not padded, so reduce-overhead records a new CUDA graph for every new batch shape "
+        "and rarely gets to replay one.",
+    )
 
 
 def make_model_from_args(
@@ -48,14 +57,51 @@ def make_model_from_args(
         num_tail_layers=args.num_tail_layers,
     )
     model = create_model(model_config, device=device)
+    if args.compile_mode != "off":
+        # Compile in place, so that parameter names (and hence saved states and the split into
+        # task-specific parameters) stay unchanged. Batches vary in their number of nodes and
+        # edges, so compile for dynamic shapes to avoid recompilation on every new batch size:
+        model.compile(mode=args.compile_mode, dynamic=True)
     return model
 
 
 def add_train_loop_arguments(parser: argparse.ArgumentParser):
     parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument(
+        "--max-num-nodes",
+        type=int,
+        default=None,
+        help="Maximal total number of nodes in a batch (in addition to the --batch_size limit on "
+        "the number of graphs).",
+    )
+    parser.add_argument(
+        "--bucket-by-num-nodes",
+        action="store_true",
+        help="Batch molecules together with molecules of similar size, to reduce the variation "
+        "of batch shapes.",
+    )
     parser.add_argument("--num_epochs", type=int, default=100)
     parser.add_argument("--patience", type=int, default=10)
     parser.add_argument("--cuda", type=int, default=5)
+    parser.add_argument(
+        "--cache-graphs-on-device",
+        action="store_true",
+        help="Keep the graphs of all tasks on the device after their first use, and assemble "
+        "batches there instead of copying them from host memory every epoch.",
+    )
+    parser.add_argument(
+        "--active-node-feature-ids",
+        action="store_true",
+        help="Pass (binary) node features to the device as the indices of their active entries, "
+        "instead of as dense float vectors.",
+    )
+    parser.add_argument(
+        "--mixed-precision",
+        type=str,
+        choices=["off", "bf16", "fp16"],
+        default="off",
+        help="Run forward passes in reduced precision using autocast.",
+    )
     parser.add_argument(
         "--learning-rate",
         type=float,
@@ -143,18 +189,30 @@ def main():
             data_fold=DataFold.TRAIN,
             task_name_to_id=train_task_name_to_id,
             max_num_graphs=args.batch_size,
+            max_num_nodes=args.max_num_nodes,
             device=device,
+            cache_graphs_on_device=args.cache_graphs_on_device,
+            bucket_by_num_nodes=args.bucket_by_num_nodes,
+            use_active_node_feature_ids=args.active_node_feature_ids,
         ),
         valid_data=MultitaskTaskSampleBatchIterable(
             fsmol_dataset,
             data_fold=DataFold.VALIDATION,
             task_name_to_id=train_task_name_to_id,
             max_num_graphs=args.batch_size,
+            max_num_nodes=args.max_num_nodes,
             device=device,
+            cache_graphs_on_device=args.cache_graphs_on_device,
+            bucket_by_num_nodes=args.bucket_by_num_nodes,
+            use_active_node_feature_ids=args.active_node_feature_ids,
         ),
         max_num_epochs=args.num_epochs,
         patience=args.patience,
         aml_run=aml_run,
+        autocast_dtype={"off": None, "bf16": torch.bfloat16, "fp16": torch.float16}[
+            args.mixed_precision
+        ],
+        mark_cudagraph_steps=args.compile_mode == "reduce-overhead" and device.type == "cuda",
     )
 
     torch.save(best_model_state, os.path.join(out_dir, "best_model.pt"))
@@ -1,18 +1,23 @@
+import csv
+import multiprocessing
 import os
+import re
+from itertools import islice
 from schrodinger.structure import StructureReader
 import pandas as pd
 
 
 def _valid_idx_to_smiles():
-    rtn = {}
     path = '/scratch/groups/rondror/jpaggi/docking_score_training/ligands/valid/'
-    for file in os.listdir(path):
-        if file.endswith('.smi'):
-            with open(path + file, 'r') as f:
-                for line in f.readlines():
-                    (smile, valid_idx) = line.split(' ')
-                    rtn[valid_idx.strip()] = smile.strip()
-    return rtn
+    # Parse the '<smiles> <valid_idx>' lines with pandas' C parser. SMILES are taken verbatim: no quoting, and strings
+    # like 'NA' are not missing values. Empty files are skipped, as read_csv raises EmptyDataError on them:
+    dfs = [pd.read_csv(entry.path, sep=r'\s+', header=None, names=['smiles', 'valid_idx'], dtype=str,
+                       engine='c', quoting=csv.QUOTE_NONE, na_filter=False)
+           for entry in os.scandir(path) if entry.name.endswith('.smi') and entry.stat().st_size > 0]
+    if not dfs:
+        return {}
+    df = pd.concat(dfs, ignore_index=True)
+    return dict(zip(df['valid_idx'].values, df['smiles'].values))
 
 
 def _process_maegz(pv, protein, valid_idx_to_smiles):
@@ -22,69 +27,105 @@ def _process_maegz(pv, protein, valid_idx_to_smiles):
             next(sts)  # protein structure is first entry.
             for st in sts:
                 key = (protein, st.title)
-                score = st.property['r_i_docking_score']
                 if key not in scores:
-                    scores[key] = score
-        scores = [[protein, ligand, valid_idx_to_smiles[ligand], score] for (protein, ligand), score in scores.items()]
-        scores = pd.DataFrame(scores, columns=['protein', 'ligand', 'smiles', 'score'])
-        scores = scores.set_index(['protein', 'ligand']).sort_index()
-    except:
-        scores = [[protein, ligand, valid_idx_to_smiles[ligand], score] for (protein, ligand), score in scores.items()]
-        scores = pd.DataFrame(scores, columns=['protein', 'ligand', 'smiles', 'score'])
-        scores = scores.set_index(['protein', 'ligand']).sort_index()
-        print(f'could not process {protein} in path {pv}')
-
-    return scores
-
-
-def _process_docking_scores(start_count, delta, valid_idx_to_smiles):
-    paths = ['/scratch/groups/rondror/jpaggi/docking_score_training/docking']
-    dfs = []
-    for idx, target in enumerate(os.listdir(''.join(paths + ['/']))):
-        # Skip until we get to the correct file.
-        if idx < start_count:
-            continue
-        # if we exceed the limit...
-        if idx >= start_count + delta:
-            df = pd.concat(dfs, axis=0)
-            df.to_csv(f'/scratch/groups/rondror/fifty/full_binding_affinities/{start_count}_{start_count + delta}.csv')
-            print(f'Finished: {start_count}')
-            return
-
-        paths.append(target)
-        for partition in os.listdir('/'.join(paths)):
-            paths.append(partition)
-            for file in os.listdir('/'.join(paths)):
-                if file.endswith('.maegz'):
-                    pv = file
-                    protein = pv.split('-to-')[-1].split('_pv')[0]
-                    paths.append(pv)
-                    dfs.append(_process_maegz('/'.join(paths), protein, valid_idx_to_smiles))
-                    paths.pop()
-            paths.pop()
-        paths.pop()
-    # In case we reach the end...
-    df = pd.concat(dfs, axis=0)
-    df.to_csv(f'/scratch/groups/rondror/fifty/full_binding_affinities/{start_count}_{start_count + delta}.csv')
+                    scores[key] = st.property['r_i_docking_score']
+    except Exception as e:
+        # Keep the scores read before the failure.
+        print(f'could not process {protein} in path {pv}: {e!r}')
+
+    rows = [(protein, ligand, valid_idx_to_smiles[ligand], score)
+            for (protein, ligand), score in scores.items() if ligand in valid_idx_to_smiles]
+    num_unknown = len(scores) - len(rows)
+    if num_unknown > 0:
+        print(f'dropped {num_unknown} ligands without a known SMILES for {protein} in path {pv}')
+    return rows
+
+
+# Set in each worker process by _init_worker, so that the (large) mapping is never sent along with the tasks. With the
+# default 'fork' start method on Linux, the pool's initargs are inherited by the forked workers without being pickled
+# at all; other start methods pickle them once per worker:
+_WORKER_VALID_IDX_TO_SMILES = None
+
+
+def _init_worker(valid_idx_to_smiles):
+    global _WORKER_VALID_IDX_TO_SMILES
+    _WORKER_VALID_IDX_TO_SMILES = valid_idx_to_smiles
+
+
+def _process_maegz_worker(pv_and_protein):
+    pv, protein = pv_and_protein
+    return _process_maegz(pv, protein, _WORKER_VALID_IDX_TO_SMILES)
+
+
+# Pose viewer files are named <ligands>-to-<protein>_pv.maegz; the protein follows the last '-to-':
+_PROTEIN_RE = re.compile(r'.*-to-(.+?)_pv')
+
+
+def _iter_target_maegz(target_path):
+    """Yields (pose viewer file path, protein) for the .maegz files in all partitions of a target directory."""
+    with os.scandir(target_path) as partitions:
+        for partition in partitions:
+            if not partition.is_dir():
+                continue
+            with os.scandir(partition.path) as entries:
+                for entry in entries:
+                    if entry.name.endswith('.maegz'):
+                        match = _PROTEIN_RE.match(entry.name)
+                        if match is None:
+                            continue
+                        yield entry.path, match.group(1)
+
+
+def _write_docking_scores(rows, path):
+    # Build and sort a single frame for the whole batch of targets, rather than one per file:
+    df = pd.DataFrame(rows, columns=['protein', 'ligand', 'smiles', 'score'])
+    df = df.set_index(['protein', 'ligand']).sort_index()
+    # Parquet is much faster to write and read back than CSV, and the files are a fraction of the size:
+    df.reset_index().to_parquet(path, compression='zstd', engine='pyarrow')
+
+
+def _num_workers():
+    """Number of worker processes to use: the CPUs allocated to this job, rather than all CPUs of the node."""
+    if 'SLURM_CPUS_PER_TASK' in os.environ:
+        return int(os.environ['SLURM_CPUS_PER_TASK'])
+    return len(os.sched_getaffinity(0))
+
+
+def _process_docking_scores(valid_idx_to_smiles, start_count=0, delta=20):
+    """Processes the targets from start_count on in batches of delta targets, writing one parquet file per batch."""
+    docking_path = '/scratch/groups/rondror/jpaggi/docking_score_training/docking'
+    output_path = '/scratch/groups/rondror/fifty/full_binding_affinities'
+    # Walk the docking directory only once, instead of once per batch, and share a single pool between all batches:
+    with os.scandir(docking_path) as entries, multiprocessing.Pool(
+        processes=_num_workers(), initializer=_init_worker, initargs=(valid_idx_to_smiles,)
+    ) as pool:
+        # islice skips the first start_count targets and then takes them delta at a time, straight from the
+        # directory iterator:
+        targets = islice(entries, start_count, None)
+        batch_start = start_count
+        while True:
+            batch = list(islice(targets, delta))
+            if not batch:
+                break
+
+            # Collect all (pose viewer file, protein) pairs of the targets in the batch first...
+            pvs_and_proteins = []
+            for target in batch:
+                pvs_and_proteins.extend(_iter_target_maegz(target.path))
+
+            # ... and then process the files in parallel, keeping the order of the sequential traversal:
+            all_rows = []
+            for rows in pool.imap(_process_maegz_worker, pvs_and_proteins, chunksize=4):
+                all_rows.extend(rows)
+
+            _write_docking_scores(all_rows, f'{output_path}/{batch_start}_{batch_start + delta}.parquet')
+            print(f'Finished: {batch_start}')
+            batch_start += delta
     print(f'Finished.')
-    return
 
 
-# TODO(cfifty): Consider multi-processing this if speedup is worth implementation time.
 if __name__ == "__main__":
     # 1932 total files...
     valid_id_to_smiles = _valid_idx_to_smiles()
-    d = 20
-    # for i in [0, 20, 40, 60, 80, 100, 120, 140, 160, 180, 200, 220, 240, 260, 280, 300, 320, 340, 360, 380, 400, 420,
-    #           440, 460, 480, 500, 520, 540, 560, 580, 600, 620, 640, 660, 680, 700, 720, 740, 760, 780, 800, 820, 840,
-    #           860, 880, 900, 920, 940, 960, 980, 1000, 1020, 1040, 1060, 1080, 1100, 1120, 1140, 1160, 1180, 1200, 1220,
-    #           1240, 1260, 1280, 1300, 1320, 1340, 1360, 1380, 1400, 1420, 1440, 1460, 1480, 1500, 1520, 1540, 1560,
-    #           1580, 1600, 1620, 1640, 1660, 1680, 1700, 1720, 1740, 1760, 1780, 1800, 1820, 1840, 1860, 1880, 1900,
-    #           1920]:
-    for i in [100, 120, 140, 160, 180, 200, 220, 240, 260, 280, 300, 320, 340, 360, 380, 400, 420,
-              440, 460, 480, 500, 520, 540, 560, 580, 600, 620, 640, 660, 680, 700, 720, 740, 760, 780, 800, 820, 840,
-              860, 880, 900, 920, 940, 960, 980, 1000, 1020, 1040, 1060, 1080, 1100, 1120, 1140, 1160, 1180, 1200, 1220,
-              1240, 1260, 1280, 1300, 1320, 1340, 1360, 1380, 1400, 1420, 1440, 1460, 1480, 1500, 1520, 1540, 1560,
-              1580, 1600, 1620, 1640, 1660, 1680, 1700, 1720, 1740, 1760, 1780, 1800, 1820, 1840, 1860, 1880, 1900,
-              1920]:
-        _process_docking_scores(start_count=i, delta=d, valid_idx_to_smiles=valid_id_to_smiles)
+    # The targets before the 100th one have been processed already; use start_count=0 to process all of them.
+    _process_docking_scores(valid_id_to_smiles, start_count=100, delta=20)
@@ -1,15 +1,28 @@
 """
 Convert binding_affinities.csv => JSON List in FS-MOL format.
 """
-import math
+import collections
+import csv
+import functools
+import gzip
+import io
+import json
+import multiprocessing
 import os
 import sys
-import csv
 import jsonlines
-import random
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
 
 from dpu_utils.utils import RichPath
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from rdkit.Chem import (
     MolFromSmiles,
 )
@@ -21,78 +34,139 @@ sys.path.insert(0, str(project_root()))
 from preprocessing.featurisers.molgraph_utils import *
 
 
+_METADATA_PTH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "utils/helper_files/")
+
+
+@functools.lru_cache(maxsize=1)
+def _load_atom_feature_extractors():
+    """Loads the atom feature extractors from the metadata file, only once per process."""
+    metapath = RichPath.create(_METADATA_PTH)
+    path = metapath.join("metadata.pkl.gz")
+    metadata = path.read_by_file_suffix()
+    return metadata["feature_extractors"]
+
+
 def smiles_list_to_processed_files(smiles_list, target, save_path=None):
     """
     Convert a smiles list => serialized list of json lines.
     """
-    metadata_pth = os.path.join(os.path.dirname(os.path.realpath(__file__)),
-                                "utils/helper_files/")
-    metapath = RichPath.create(metadata_pth)
-    path = metapath.join("metadata.pkl.gz")
-    metadata = path.read_by_file_suffix()
-    atom_feature_extractors = metadata["feature_extractors"]
-
-    rtn = {target: []}
-    for smiles in smiles_list:
-        rdkit_mol = MolFromSmiles(smiles)
-        g = molecule_to_graph(rdkit_mol, atom_feature_extractors)
-        rtn[target].append({
-            'SMILES': smiles,
-            'graph': g,
-        })
+    # Parse and featurise in the same process pool as csv_to_processed_files, keeping the order of the list:
+    with multiprocessing.Pool(processes=_num_workers(), initializer=_load_atom_feature_extractors) as pool:
+        rtn = {target: list(pool.imap(_featurise_smiles, smiles_list, chunksize=256))}
     serialize(rtn, save_path, 'test')
 
 
+if orjson is not None:
+    def _dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS).decode()
+else:
+    # Without orjson, fall back to the stdlib encoder, with the same compact separators:
+    _dumps = json.JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode
+
+
 def serialize(rtn, save_path, dataset='train'):
-    """Serializes rtn dictionary to jsonl file stored on disk.
+    """Serializes rtn dictionary to gzipped jsonl files stored on disk.
 
     Note: Must use .gz ending to be compatible with previous FS-Mol code.
     """
     path = f'{save_path}/{dataset}'
     for key in rtn:
-        with jsonlines.open(f'{path}/{key}.jsonl.gz', mode='w') as writer:
+        # Write through a large buffer, and favour speed over compression ratio:
+        with open(f'{path}/{key}.jsonl.gz', 'wb', buffering=1 << 20) as f, \
+                gzip.GzipFile(fileobj=f, mode='wb', compresslevel=1) as gz_f, \
+                io.TextIOWrapper(gz_f, encoding='utf-8') as text_f, \
+                jsonlines.Writer(text_f, dumps=_dumps) as writer:
             writer.write_all(rtn[key])
 
 
+def _featurise_smiles(smiles):
+    """Featurises one molecule in a worker; RDKit molecules are only created (and never pickled) there."""
+    rdkit_mol = MolFromSmiles(smiles)
+    g = molecule_to_graph(rdkit_mol, _load_atom_feature_extractors())
+    return {
+        'SMILES': smiles,
+        'graph': g,
+    }
+
+
+def _featurise_scored_smiles(smiles_and_score):
+    smiles, score = smiles_and_score
+    datapoint = _featurise_smiles(smiles)
+    datapoint['RegressionProperty'] = float(score)
+    return datapoint
+
+
+def _num_workers():
+    """Number of worker processes to use: the CPUs allocated to this job, rather than all CPUs of the node."""
+    if 'SLURM_CPUS_PER_TASK' in os.environ:
+        return int(os.environ['SLURM_CPUS_PER_TASK'])
+    return len(os.sched_getaffinity(0))
+
+
+def _read_binding_scores(binding_scores_path):
+    """Streams the protein, SMILES and score columns of a binding scores CSV in record batches.
+
+    Parsing is done by pyarrow's multi-threaded CSV reader. Missing scores are returned as nulls.
+    """
+    # Fields may be separated by ', ', so read the column names ourselves and strip the values below:
+    with open(binding_scores_path, newline='') as f:
+        column_names = next(csv.reader(f, skipinitialspace=True))
+    reader = pacsv.open_csv(
+        binding_scores_path,
+        read_options=pacsv.ReadOptions(column_names=column_names, skip_rows=1, block_size=64 << 20),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=['protein', 'SMILES', 'score'],
+            column_types={'protein': pa.string(), 'SMILES': pa.string(), 'score': pa.string()},
+        ),
+    )
+    for batch in reader:
+        proteins = pc.utf8_ltrim_whitespace(batch.column('protein'))
+        smiles = pc.utf8_ltrim_whitespace(batch.column('SMILES'))
+        # Scores are read as strings, so that blank ones can be turned into nulls before the conversion:
+        scores = pc.utf8_trim_whitespace(batch.column('score'))
+        scores = pc.if_else(pc.equal(scores, ''), pa.scalar(None, pa.string()), scores)
+        yield proteins, smiles, pc.cast(scores, pa.float64())
+
+
 def csv_to_processed_files(save_path=None, binding_scores_path='binding_scores/docking_scores.csv'):
     """
     Convert binding_affinities.csv => jsonl file format used in FS-Mol.
     """
-    metadata_pth = os.path.join(os.path.dirname(os.path.realpath(__file__)),
-                                "utils/helper_files/")
-    metapath = RichPath.create(metadata_pth)
-    path = metapath.join("metadata.pkl.gz")
-    metadata = path.read_by_file_suffix()
-    atom_feature_extractors = metadata["feature_extractors"]
-
-    with open(binding_scores_path) as f:
-        csv_data = [{k: v for k, v in row.items()}
-                    for row in csv.DictReader(f, skipinitialspace=True)]
-
     rtn = {}
-    for row in csv_data:
-        if row['protein'] not in rtn:
-            rtn[row['protein']] = []
-        # Skip this molecule if we don't have a score for it...
-        if row['score'] is '':
-            continue
-        smiles = row['SMILES']
-        rdkit_mol = MolFromSmiles(smiles)
-        g = molecule_to_graph(rdkit_mol, atom_feature_extractors)
-        rtn[row['protein']].append({
-            'SMILES': smiles,
-            'graph': g,
-            'RegressionProperty': float(row['score'])
-        })
-    random.seed(0)
+    scored_proteins, scored_smiles_and_scores = [], []
+    for proteins, smiles, scores in _read_binding_scores(binding_scores_path):
+        # Keep every target, also those without any scored molecules:
+        for protein in pc.unique(proteins).to_pylist():
+            if protein not in rtn:
+                rtn[protein] = []
+        # Skip the molecules we don't have a score for:
+        is_scored = pc.is_valid(scores)
+        scored_proteins.extend(proteins.filter(is_scored).to_pylist())
+        scored_smiles_and_scores.extend(zip(smiles.filter(is_scored).to_pylist(), scores.filter(is_scored).to_pylist()))
+
+    # We know how many molecules each target gets, so allocate their lists up front instead of growing them:
+    num_scored = collections.Counter(scored_proteins)
+    rtn = {target: [None] * num_scored[target] for target in rtn}
+    next_idx = dict.fromkeys(rtn, 0)
+
+    # Featurise in parallel; imap keeps the order of the rows, so the random splits below are unchanged:
+    # Each worker loads the atom feature extractors once on start-up, instead of receiving them with every task:
+    with multiprocessing.Pool(processes=_num_workers(), initializer=_load_atom_feature_extractors) as pool:
+        featurised_datapoints = pool.imap(_featurise_scored_smiles, scored_smiles_and_scores, chunksize=256)
+        for protein, datapoint in zip(scored_proteins, featurised_datapoints):
+            rtn[protein][next_idx[protein]] = datapoint
+            next_idx[protein] += 1
+
+    # Split each target's datapoints with a random permutation of their indices, which is drawn in one go:
+    rng = np.random.default_rng(0)
     train_data = {}
     valid_data = {}
-    for target in rtn:
-        num_ligands = len(rtn[target])
+    for target, datapoints in rtn.items():
+        num_ligands = len(datapoints)
         valid_split = int(num_ligands * 0.8)
-        random.shuffle(rtn[target])
-        train_data[target] = (rtn[target])[:valid_split]
-        valid_data[target] = (rtn[target])[valid_split:]
+        permutation = rng.permutation(num_ligands)
+        train_data[target] = [datapoints[i] for i in permutation[:valid_split]]
+        valid_data[target] = [datapoints[i] for i in permutation[valid_split:]]
 
     serialize(train_data, save_path, 'train')
     serialize(valid_data, save_path, 'valid')
@@ -100,7 +174,6 @@ def csv_to_processed_files(save_path=None, binding_scores_path='binding_scores/d
     print(f'Finished featurizing binding affinity scores.')
 
 
-# TODO(cfifty): Consider multi-processing this if speedup is worth implementation time.
 if __name__ == "__main__":
     raise Exception("this isn't working... Run from FS-Mol original directory instead..")
     path = '../glide_csv_raw'
@@ -1,9 +1,12 @@
 from collections import defaultdict
-from typing import DefaultDict, Dict, Callable
+from typing import DefaultDict, Dict, Callable, Union
 
 import torch
 
 
+MetricValueType = Union[float, torch.Tensor]
+
+
 class MetricLogger:
     def __init__(
         self,
@@ -20,18 +23,20 @@ class MetricLogger:
         self._aml_run = aml_run
 
         self._step_counter = 0
-        self._metrics: DefaultDict[str, float] = defaultdict(lambda: 0.0)
-        self._windowed_metrics: DefaultDict[str, float] = defaultdict(lambda: 0.0)
+        # Tensor-valued metrics are summed up on their device, and only copied to the host when
+        # they are reported, as every copy forces a synchronisation with the device:
+        self._metrics: DefaultDict[str, MetricValueType] = defaultdict(lambda: 0.0)
+        self._windowed_metrics: DefaultDict[str, MetricValueType] = defaultdict(lambda: 0.0)
 
     @staticmethod
-    def __format_metric_dict(metric_dict: Dict[str, float], num_steps: int) -> str:
+    def __format_metric_dict(metric_dict: Dict[str, MetricValueType], num_steps: int) -> str:
         return ", ".join(
-            f"{metric_name}: {metric_val/num_steps:.5f}"
+            f"{metric_name}: {float(metric_val)/num_steps:.5f}"
             for metric_name, metric_val in metric_dict.items()
         )
 
     def get_mean_metric_value(self, metric_name: str) -> float:
-        return self._metrics[metric_name] / self._step_counter
+        return float(self._metrics[metric_name]) / self._step_counter
 
     @property
     def metric_overview(self):
@@ -40,7 +45,7 @@ class MetricLogger:
     def log_metrics(self, **kwargs) -> None:
         for metric_name, metric_val in kwargs.items():
             if isinstance(metric_val, torch.Tensor):
-                metric_val = metric_val.detach().cpu().item()
+                metric_val = metric_val.detach().double()
             self._metrics[metric_name] += metric_val
             self._windowed_metrics[metric_name] += metric_val
 
@@ -59,6 +64,7 @@ class MetricLogger:
             if self._aml_run is not None:
                 for metric_name, metric_val in self._windowed_metrics.items():
                     self._aml_run.log(
-                        f"{self._metric_name_prefix}{metric_name}", metric_val / self._window_size
+                        f"{self._metric_name_prefix}{metric_name}",
+                        float(metric_val) / self._window_size,
                     )
             self._windowed_metrics.clear()
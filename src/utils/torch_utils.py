@@ -1,26 +1,176 @@
 import dataclasses
+import queue
+import threading
+from typing import Iterable, Iterator, TypeVar
 
 import numpy as np
 import torch
 
 
-def torchify(data, device: torch.device):
+T = TypeVar("T")
+
+
+def torchify(data, device: torch.device, non_blocking: bool = False):
     if isinstance(data, (int, float, str, torch.Tensor)):
         return data
     elif isinstance(data, tuple):
-        return tuple(torchify(e, device) for e in data)
+        return tuple(torchify(e, device, non_blocking) for e in data)
     elif isinstance(data, list):
-        return list(torchify(e, device) for e in data)
+        return list(torchify(e, device, non_blocking) for e in data)
     elif isinstance(data, dict):
-        return {k: torchify(v, device) for k, v in data.items()}
+        return {k: torchify(v, device, non_blocking) for k, v in data.items()}
     elif isinstance(data, np.ndarray):
-        return torch.from_numpy(data).to(device)
+        tensor = torch.from_numpy(data)
+        if non_blocking:
+            # Copies from pageable memory are synchronous, so go through pinned memory:
+            tensor = tensor.pin_memory()
+        return tensor.to(device, non_blocking=non_blocking)
     elif dataclasses.is_dataclass(data):
         # Note that we can't use dataclasses.asdict, as this recursively turns
         # all values into dicts as well, so that we lose the inner structure...
         torch_data = {
-            f.name: torchify(getattr(data, f.name), device) for f in dataclasses.fields(data)
+            f.name: torchify(getattr(data, f.name), device, non_blocking)
+            for f in dataclasses.fields(data)
         }
         return dataclasses.replace(data, **torch_data)
     else:
         raise ValueError(f"Trying to torchify unknown value type {type(data)}!")
+
+
+def record_stream(data, stream: torch.cuda.Stream) -> None:
+    """Mark all tensors in data as used on stream, so that their memory is not re-used before
+    the work queued on stream is done."""
+    if isinstance(data, torch.Tensor):
+        data.record_stream(stream)
+    elif isinstance(data, (tuple, list)):
+        for e in data:
+            record_stream(e, stream)
+    elif isinstance(data, dict):
+        for v in data.values():
+            record_stream(v, stream)
+    elif dataclasses.is_dataclass(data):
+        for f in dataclasses.fields(data):
+            record_stream(getattr(data, f.name), stream)
+
+
+class DataPrefetcher(Iterator[T]):
+    """Torchify the elements of an iterable on a side CUDA stream, one element ahead of the
+    consumer, so that host-to-device copies overlap with the work queued on the current stream.
+
+    Args:
+        data_iterable: Iterable of data in host memory, in a form accepted by torchify.
+        device: CUDA device to move the data to.
+    """
+
+    _END = object()
+
+    def __init__(self, data_iterable: Iterable[T], device: torch.device):
+        self._data_iter = iter(data_iterable)
+        self._device = device
+        self._stream = torch.cuda.Stream(device=device)
+        self._preload()
+
+    def _preload(self) -> None:
+        try:
+            data = next(self._data_iter)
+        except StopIteration:
+            self._next_data = self._END
+            return
+
+        with torch.cuda.stream(self._stream):
+            self._next_data = torchify(data, self._device, non_blocking=True)
+
+    def __iter__(self) -> Iterator[T]:
+        return self
+
+    def close(self) -> None:
+        """Stop reading from the underlying iterable, e.g. when the consumer stops early."""
+        close = getattr(self._data_iter, "close", None)
+        if close is not None:
+            close()
+
+    def __next__(self) -> T:
+        if self._next_data is self._END:
+            raise StopIteration
+
+        current_stream = torch.cuda.current_stream(self._device)
+        current_stream.wait_stream(self._stream)
+        data = self._next_data
+        record_stream(data, current_stream)
+        self._preload()
+        return data
+
+
+class ThreadedPrefetcher(Iterator[T]):
+    """Compute the elements of an iterable in a background thread, up to max_queue_size elements
+    ahead of the consumer.
+
+    Unlike dpu_utils' ThreadedIterator, the thread does not have to run to the end of the iterable:
+    close() (also called when the prefetcher is garbage collected, e.g. after the consumer breaks
+    out of a loop over it) signals the thread to stop, and waits for it.
+
+    Args:
+        data_iterable: Iterable of data to prefetch.
+        max_queue_size: Maximal number of elements computed ahead of the consumer.
+    """
+
+    _END = object()
+
+    def __init__(self, data_iterable: Iterable[T], max_queue_size: int):
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self._stop_event = threading.Event()
+        self._done = False
+        # The thread must not hold a reference to self, so that the prefetcher can be garbage
+        # collected (and hence closed) while the thread is blocked on a full queue:
+        self._thread = threading.Thread(
+            target=ThreadedPrefetcher._produce,
+            args=(iter(data_iterable), self._queue, self._stop_event),
+            daemon=True,
+        )
+        self._thread.start()
+
+    @staticmethod
+    def _produce(data_iter: Iterator[T], data_queue: queue.Queue, stop_event: threading.Event):
+        def put(item) -> bool:
+            # Time out regularly, to notice when the consumer has stopped:
+            while not stop_event.is_set():
+                try:
+                    data_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for data in data_iter:
+                if not put((data, None)):
+                    return
+            put((ThreadedPrefetcher._END, None))
+        except Exception as e:
+            put((ThreadedPrefetcher._END, e))
+        finally:
+            close = getattr(data_iter, "close", None)
+            if close is not None:
+                close()
+
+    def __iter__(self) -> Iterator[T]:
+        return self
+
+    def __next__(self) -> T:
+        if self._done:
+            raise StopIteration
+        data, error = self._queue.get()
+        if data is self._END:
+            self.close()
+            if error is not None:
+                raise error
+            raise StopIteration
+        return data
+
+    def close(self) -> None:
+        self._done = True
+        self._stop_event.set()
+        self._thread.join()
+
+    def __del__(self) -> None:
+        self.close()